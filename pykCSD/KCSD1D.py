@@ -1,8 +1,8 @@
 # -*- coding: utf-8 -*-
 
+from functools import partial
+
 import numpy as np
-from numpy import dot, identity
-from numpy.linalg import norm, inv
 
 from . import basis_functions as bf
 from . import source_distribution as sd
@@ -10,9 +10,11 @@ from . import potentials as pt
 from . import dist_table_utils as dt
 from . import plotting_utils as plut
 from . import parameters_utils as parut
+from . import estimation_utils as eu
+from . import matrix_utils as mu
 
 
-class KCSD1D(object):
+class KCSD1D(eu.KCSDBase):
     """
     1D variant of solver for the Kernel Current Source Density method.
 
@@ -24,8 +26,10 @@ class KCSD1D(object):
     elec_pos : numpy array
         positions of electrodes
 
-    sampled_pots : numpy array
-        potentials measured by electrodes
+    sampled_pots : numpy array, numpy memmap or h5py dataset, optional
+        potentials measured by electrodes, may be omitted if the model
+        is only applied to new recordings with transform(); on-disk
+        arrays are read in time chunks during the estimation
     
     params : set, optional
         configuration parameters, that may contain the following keys:
@@ -58,18 +62,66 @@ class KCSD1D(object):
         
         'lambd' : float
             regularization parameter for ridge regression
+
+        'chunk_size' : int
+            number of time samples estimated at once by the iterators
+            and read at once from on-disk potentials
+
+        'mem_budget' : int
+            memory (in bytes) for temporary blocks used to build the model
+
+        'low_memory' : bool
+            if True, k_interp_cross and interp_pot are accumulated block by
+            block and b_src_matrix and b_interp_pot_matrix are never stored
+
+        'sparse_basis' : bool
+            if True, b_src_matrix of a compactly supported basis ('step',
+            'gauss_lim') is built as a scipy.sparse matrix
+
+        'fft' : bool
+            if True and the sources lie on a lattice aligned with the
+            estimation grid, k_interp_cross and interp_pot are computed
+            as FFT convolutions
+
+        'n_jobs' : int
+            number of workers computing the dist_table
+
+        'executor' : str
+            type of the dist_table workers ('thread' or 'process')
+
+        'dist_table_cache' : str
+            directory of the on-disk cache of distance tables, which
+            are reused by models with the same basis and potential
+
+        'dist_table_cache_size' : int
+            limit (in bytes) of the dist_table cache size
+
+        'dist_table_step' : float
+            if given, the dist_table is sampled with this step up to the first
+            multiple of it beyond the estimation space diagonal, instead of
+            with the given density; models with a smaller estimation space
+            then reuse the cached tables of larger ones by truncation
+
+        'scaled_potentials' : bool
+            if True, the numerically integrated dist_table is rescaled
+            from a master table computed once per basis and h/R ratio
+
+        'dist_lookup' : str
+            evaluation of the potentials from the dist_table, 'nearest'
+            sample or 'spline' interpolation between the samples (which
+            needs a lower dist_table resolution for the same accuracy)
     """
 
-    def __init__(self, elec_pos, sampled_pots, params={}):
+    def __init__(self, elec_pos, sampled_pots=None, params={}):
         self.validate_parameters(elec_pos, sampled_pots)
         self.elec_pos = elec_pos
         self.sampled_pots = sampled_pots
         self.set_parameters(params)
+        self._k_pot_factorization = None
 
     def validate_parameters(self, elec_pos, sampled_pots):
-        if elec_pos.shape[0] != sampled_pots.shape[0]:
-            raise Exception("Number of measured potentials is not equal "
-                            "to electrode number!")
+        if sampled_pots is not None:
+            self.validate_pots(elec_pos, sampled_pots)
         if elec_pos.shape[0] < 2:
             raise Exception("Number of electrodes must be at least 2!")
         if parut.check_for_duplicated_electrodes(elec_pos) is False:
@@ -83,6 +135,18 @@ class KCSD1D(object):
             'xmax': np.max(self.elec_pos),
             'dist_density': 200,
             'lambd': 0.0,
+            'chunk_size': 1000,
+            'mem_budget': 2**27,
+            'low_memory': False,
+            'sparse_basis': True,
+            'fft': False,
+            'n_jobs': 1,
+            'executor': 'thread',
+            'dist_table_cache': None,
+            'dist_table_cache_size': dt.CACHE_SIZE,
+            'dist_table_step': None,
+            'scaled_potentials': False,
+            'dist_lookup': 'nearest',
             'R_init': 2 * parut.min_dist(self.elec_pos),
             'ext': 0.0,
             'h': 1.0,
@@ -112,32 +176,9 @@ class KCSD1D(object):
                                               self.n_sources, self.R_init)
         Lx = np.max(self.X_src) - np.min(self.X_src) + self.R
         self.dist_max = Lx
-
-    def estimate_pots(self):
-        """Calculates Local Field Potentials."""
-        estimation_table = self.interp_pot
-        self.estimated_pots = self.estimate(estimation_table)
-        return self.estimated_pots
-
-    def estimate_csd(self):
-        """Calculates Current Source Density."""
-        estimation_table = self.k_interp_cross
-        self.estimated_csd = self.estimate(estimation_table)
-        return self.estimated_csd
-
-    def estimate(self, estimation_table):
-        k_inv = inv(self.k_pot + self.lambd * identity(self.k_pot.shape[0]))
-        nt = self.sampled_pots.shape[1]
-        estimation = np.zeros((self.nx, nt))
-        for t in range(nt):
-            beta = dot(k_inv, self.sampled_pots[:, t])
-            for i in range(self.elec_pos.shape[0]):
-                estimation[:, t] += beta[i] * estimation_table[:, i]
-        return estimation
-
-    def save(self, filename='result'):
-        """Save results to file."""
-        pass
+        if self.dist_table_step is not None:
+            (self.dist_density, self.dist_max) = dt.fixed_step_table(
+                self.dist_max, self.dist_table_step)
 
     def __repr__(self):
         info = ''.join(self.__class__.__name__)
@@ -155,72 +196,51 @@ class KCSD1D(object):
     # subfunctions
     #
 
-    def init_model(self):
-        """
-        Prepares all the required matrices to calculate kCSD.
-        """
-        self.create_dist_table()
-
-        self.calculate_b_pot_matrix()
-        self.k_pot = dot(self.b_pot_matrix.T, self.b_pot_matrix)
-
-        self.calculate_b_src_matrix()
-        self.k_interp_cross = dot(self.b_src_matrix, self.b_pot_matrix)
-
-        self.calculate_b_interp_pot_matrix()
-        self.interp_pot = dot(self.b_interp_pot_matrix, self.b_pot_matrix)
-
     def create_dist_table(self):
         """
         Creates table of a single source contribution to overall potential
         as a function of distance.
         """
-        self.dist_table = np.zeros(self.dist_density)
-
-        for i in range(0, self.dist_density):
-            pos = (i/self.dist_density) * self.dist_max
-            self.dist_table[i] = pt.b_pot_1d_cont(0, pos, self.R, self.h,
-                                                  self.sigma, self.basis)
+        pot_func = pt.b_pot_1d
+        if self.scaled_potentials:
+            pot_func = partial(pt.b_pot_scaled, pot_func)
+        self.dist_table = dt.create_dist_table(
+            self.basis, pot_func, self.R, self.h, self.sigma,
+            self.dist_max, self.dist_density, vectorized=True,
+            n_jobs=self.n_jobs, executor=self.executor,
+            cache_dir=self.dist_table_cache,
+            cache_size=self.dist_table_cache_size)
 
     def calculate_b_pot_matrix(self):
         """
         Computes the matrix of potentials generated by every
         source basis function at every electrode position.
         """
-        n_obs = self.elec_pos.shape[0]
-        nx, = self.X_src.shape
-        n = nx
-
-        self.b_pot_matrix = np.zeros((n, n_obs))
-
-        for i in range(0, n):
-            # finding the coordinates of the i-th source
-            src = self.X_src[i]
-
-            for j in range(0, n_obs):
-                # for all the observation points
-                # checking the distance between the observation point
-                # and the source, and calculating the base value
-                dist = norm(self.elec_pos[j] - src)
-
-                self.b_pot_matrix[i, j] = dt.generated_potential(
-                    dist,
-                    self.dist_max,
-                    self.dist_table
-                )
+        elec_pos = np.reshape(self.elec_pos, (-1, 1))
+        self.b_pot_matrix = mu.calculate_b_pot_matrix(self.source_positions(),
+                                                      elec_pos,
+                                                      self.dist_max,
+                                                      self.potential_lookup())
 
     def calculate_b_src_matrix(self):
         """
         Compute the matrix of basis sources.
         """
-        ngx = len(self.space_X)
-        n = self.n_sources
-
-        self.b_src_matrix = np.zeros((ngx, n))
-
-        for i in range(n):
-            x_src = self.X_src[i]
-            self.b_src_matrix[:, i] = self.basis(self.space_X, x_src, self.R)
+        if self.sparse_basis and bf.has_compact_support(self.basis):
+            self.b_src_matrix = mu.calculate_sparse_b_src_matrix(
+                self.basis,
+                self.grid_positions(),
+                self.source_positions(),
+                self.R
+            )
+        else:
+            self.b_src_matrix = mu.calculate_b_src_matrix(
+                self.basis,
+                self.grid_positions(),
+                self.source_positions(),
+                self.R,
+                self.mem_budget
+            )
 
     def calculate_b_interp_pot_matrix(self):
         """
@@ -233,25 +253,32 @@ class KCSD1D(object):
         """
         Calculate b_interp_pot_matrix
         """
-        ngx, = self.space_X.shape
-        ng = ngx
-
-        nsx, = self.X_src.shape
-        n_src = nsx
-
-        self.b_interp_pot_matrix = np.zeros((ngx, n_src))
-
-        for i in range(0, n_src):
-            # getting the coordinates of the i-th source
-            x_src = self.X_src[i]
-            norms = np.sqrt((self.space_X - x_src)**2)
-            self.b_interp_pot_matrix[:, i] = dt.generated_potential(
-                norms,
-                self.dist_max,
-                self.dist_table
-            )
+        self.b_interp_pot_matrix = mu.calculate_b_interp_pot_matrix(
+            self.grid_positions(),
+            self.source_positions(),
+            self.dist_max,
+            self.potential_lookup(),
+            self.mem_budget
+        )
+
+    def grid_coordinates(self):
+        """
+        Returns the coordinates of the estimation space stored with
+        the results.
+        """
+        return {'space_X': self.space_X}
 
-        self.b_interp_pot_matrix = self.b_interp_pot_matrix.reshape(ng, n_src)
+    def grid_positions(self):
+        """
+        Returns the points of the estimation space (n_grid x 1).
+        """
+        return self.space_X.reshape(-1, 1)
+
+    def source_positions(self):
+        """
+        Returns the positions of the sources (n_src x 1).
+        """
+        return self.X_src.reshape(-1, 1)
 
 
 def main():
@@ -1,8 +1,8 @@
 # -*- coding: utf-8 -*-
 
+from functools import partial
+
 import numpy as np
-from numpy import dot, identity
-from numpy.linalg import norm, inv
 
 from . import basis_functions as bf
 from . import source_distribution as sd
@@ -10,9 +10,11 @@ from . import potentials as pt
 from . import dist_table_utils as dt
 from . import plotting_utils as plut
 from . import parameters_utils as parut
+from . import estimation_utils as eu
+from . import matrix_utils as mu
 
 
-class KCSD3D(object):
+class KCSD3D(eu.KCSDBase):
     """
     3D variant of the kCSD method.
     It assumes sources are distributed in 3D space.
@@ -22,8 +24,10 @@ class KCSD3D(object):
     elec_pos : numpy array
         positions of electrodes
 
-    sampled_pots : numpy array
-        potentials measured by electrodes
+    sampled_pots : numpy array, numpy memmap or h5py dataset, optional
+        potentials measured by electrodes, may be omitted if the model
+        is only applied to new recordings with transform(); on-disk
+        arrays are read in time chunks during the estimation
     
     params : set, optional
         configuration parameters, that may contain the following keys:
@@ -57,18 +61,66 @@ class KCSD3D(object):
     
         'lambd' : float
             regularization parameter for ridge regression
+
+        'chunk_size' : int
+            number of time samples estimated at once by the iterators
+            and read at once from on-disk potentials
+
+        'mem_budget' : int
+            memory (in bytes) for temporary blocks used to build the model
+
+        'low_memory' : bool
+            if True, k_interp_cross and interp_pot are accumulated block by
+            block and b_src_matrix and b_interp_pot_matrix are never stored
+
+        'sparse_basis' : bool
+            if True, b_src_matrix of a compactly supported basis ('step',
+            'gauss_lim') is built as a scipy.sparse matrix
+
+        'fft' : bool
+            if True and the sources lie on a lattice aligned with the
+            estimation grid, k_interp_cross and interp_pot are computed
+            as FFT convolutions
+
+        'n_jobs' : int
+            number of workers computing the dist_table
+
+        'executor' : str
+            type of the dist_table workers ('thread' or 'process')
+
+        'dist_table_cache' : str
+            directory of the on-disk cache of distance tables, which
+            are reused by models with the same basis and potential
+
+        'dist_table_cache_size' : int
+            limit (in bytes) of the dist_table cache size
+
+        'dist_table_step' : float
+            if given, the dist_table is sampled with this step up to the first
+            multiple of it beyond the estimation space diagonal, instead of
+            with the given density; models with a smaller estimation space
+            then reuse the cached tables of larger ones by truncation
+
+        'scaled_potentials' : bool
+            if True, the numerically integrated dist_table is rescaled
+            from a master table computed once per basis
+
+        'dist_lookup' : str
+            evaluation of the potentials from the dist_table, 'nearest'
+            sample or 'spline' interpolation between the samples (which
+            needs a lower dist_table resolution for the same accuracy)
     """
 
-    def __init__(self, elec_pos, sampled_pots, params={}):
+    def __init__(self, elec_pos, sampled_pots=None, params={}):
         self.validate_parameters(elec_pos, sampled_pots)
         self.elec_pos = elec_pos
         self.sampled_pots = sampled_pots
         self.set_parameters(params)
+        self._k_pot_factorization = None
 
     def validate_parameters(self, elec_pos, sampled_pots):
-        if elec_pos.shape[0] != sampled_pots.shape[0]:
-            raise Exception("Number of measured potentials is not equal \
-                             to electrode number!")
+        if sampled_pots is not None:
+            self.validate_pots(elec_pos, sampled_pots)
         if elec_pos.shape[0] < 4:
             raise Exception("Number of electrodes must be at least 4!")
         if parut.check_for_duplicated_electrodes(elec_pos) is False:
@@ -86,6 +138,18 @@ class KCSD3D(object):
             'zmax': np.max(self.elec_pos[:, 2]),
             'dist_table_density': 100,
             'lambd': 0.0,
+            'chunk_size': 1000,
+            'mem_budget': 2**27,
+            'low_memory': False,
+            'sparse_basis': True,
+            'fft': False,
+            'n_jobs': 1,
+            'executor': 'thread',
+            'dist_table_cache': None,
+            'dist_table_cache_size': dt.CACHE_SIZE,
+            'dist_table_step': None,
+            'scaled_potentials': False,
+            'dist_lookup': 'nearest',
             'R_init': 2 * parut.min_dist(self.elec_pos),
             'ext_X': 0.0,
             'ext_Y': 0.0,
@@ -133,36 +197,9 @@ class KCSD3D(object):
         Ly = np.max(self.Y_src) - np.min(self.Y_src) + self.R
         Lz = np.max(self.Z_src) - np.min(self.Z_src) + self.R
         self.dist_max = (Lx**2 + Ly**2 + Lz**2)**0.5
-
-    def estimate_pots(self):
-        """Calculates Local Field Potentials."""
-        estimation_table = self.interp_pot
-        self.estimated_pots = self.estimate(estimation_table)
-        return self.estimated_pots
-
-    def estimate_csd(self):
-        """Calculates Current Source Density."""
-        estimation_table = self.k_interp_cross
-        self.estimated_csd = self.estimate(estimation_table)
-        return self.estimated_csd
-
-    def estimate(self, estimation_table):
-        k_inv = inv(self.k_pot + self.lambd * identity(self.k_pot.shape[0]))
-        nt = self.sampled_pots.shape[1]
-        (nx, ny, nz) = self.space_X.shape
-        estimation = np.zeros((nx * ny * nz, nt))
-
-        for t in range(nt):
-            beta = dot(k_inv, self.sampled_pots[:, t])
-            for i in range(self.elec_pos.shape[0]):
-                estimation[:, t] += beta[i] * estimation_table[:, i]
-
-        estimation = estimation.reshape(nx, ny, nz, nt)
-        return estimation
-
-    def save(self, filename='result'):
-        """Save results to file."""
-        pass
+        if self.dist_table_step is not None:
+            (self.dist_table_density, self.dist_max) = dt.fixed_step_table(
+                self.dist_max, self.dist_table_step)
 
     def __repr__(self):
         info = ''.join(self.__class__.__name__)
@@ -182,21 +219,6 @@ class KCSD3D(object):
     # subfunctions
     #
 
-    def init_model(self):
-        """
-        Prepares all the required matrices to calculate CSD and potentials.
-        """
-        self.create_dist_table()
-
-        self.calculate_b_pot_matrix()
-        self.k_pot = dot(self.b_pot_matrix.T, self.b_pot_matrix)
-
-        self.calculate_b_src_matrix()
-        self.k_interp_cross = dot(self.b_src_matrix, self.b_pot_matrix)
-
-        self.calculate_b_interp_pot_matrix()
-        self.interp_pot = dot(self.b_interp_pot_matrix, self.b_pot_matrix)
-
     def create_dist_table(self):
         """
         Create table of a single source base element contribution
@@ -204,22 +226,18 @@ class KCSD3D(object):
         The last record corresponds to the distance equal to the
         diagonal of the cuboid.
         """
-        self.dist_table = dt.create_dist_table(self.basis,
-                                               pt.b_pot_3d_mc,
-                                               self.R,
-                                               self.h,
-                                               self.sigma,
-                                               self.dist_max,
-                                               self.dist_table_density
-                                               )
-        """self.dist_table = dt.create_dist_table(self.basis,
-                                               pt.b_pot_3d_analytic,
-                                               self.R,
-                                               self.h,
-                                               self.sigma,
-                                               self.dist_max,
-                                               self.dist_table_density
-                                               )"""
+        if self.basis in pt.ANALYTIC_POTENTIALS_3D:
+            pot_func = pt.b_pot_3d_analytic
+        elif self.scaled_potentials:
+            pot_func = partial(pt.b_pot_scaled, pt.b_pot_3d_radial)
+        else:
+            pot_func = pt.b_pot_3d_radial
+        self.dist_table = dt.create_dist_table(
+            self.basis, pot_func, self.R, self.h, self.sigma,
+            self.dist_max, self.dist_table_density, vectorized=True,
+            n_jobs=self.n_jobs, executor=self.executor,
+            cache_dir=self.dist_table_cache,
+            cache_size=self.dist_table_cache_size)
 
     def calculate_b_pot_matrix(self):
         """
@@ -234,31 +252,10 @@ class KCSD3D(object):
         the potential basis functions in all the electrode
         positions (essential for calculating the cross_matrix)
         """
-        n_obs = self.elec_pos.shape[0]
-        (nx, ny, nz) = self.X_src.shape
-        n = nx * ny * nz
-
-        self.b_pot_matrix = np.zeros((n, n_obs))
-
-        for i in range(0, n):
-            # finding the coordinates of the i-th source
-            i_x, i_y, i_z = np.unravel_index(i, (nx, ny, nz))
-            src = [self.X_src[i_x, i_y, i_z],
-                   self.Y_src[i_x, i_y, i_z],
-                   self.Z_src[i_x, i_y, i_z]]
-
-            for j in range(0, n_obs):
-                # for all the observation points
-                # checking the distance between the observation point and
-                # the source,
-                # calculating the base value
-                dist = norm(self.elec_pos[j] - src)
-
-                self.b_pot_matrix[i, j] = dt.generated_potential(
-                    dist,
-                    self.dist_max,
-                    self.dist_table
-                )
+        src_pos = self.source_positions(order='C')
+        self.b_pot_matrix = mu.calculate_b_pot_matrix(src_pos, self.elec_pos,
+                                                      self.dist_max,
+                                                      self.potential_lookup())
 
     def calculate_b_src_matrix(self):
         """
@@ -272,32 +269,28 @@ class KCSD3D(object):
         all the source basis functions in all the points at which we want to
         calculate the solution (essential for calculating the cross_matrix)
         """
-        (nsx, nsy, nsz) = self.X_src.shape
-        n = nsy * nsx * nsz  # total number of sources
-        (ngx, ngy, ngz) = self.space_X.shape
-        ng = ngx * ngy * ngz
-
-        self.b_src_matrix = np.zeros((self.space_X.shape[0],
-                                     self.space_X.shape[1],
-                                     self.space_X.shape[2],
-                                     n))
-
-        for i in range(n):
-            # getting the coordinates of the i-th source
-            (i_x, i_y, i_z) = np.unravel_index(i, (nsx, nsy, nsz), order='F')
-            z_src = self.Z_src[i_x, i_y, i_z]
-            y_src = self.Y_src[i_x, i_y, i_z]
-            x_src = self.X_src[i_x, i_y, i_z]
-
-            self.b_src_matrix[:, :, :, i] = self.basis(
-                self.space_X,
-                self.space_Y,
-                self.space_Z,
-                [x_src, y_src, z_src],
+        if self.sparse_basis and bf.has_compact_support(self.basis):
+            self.b_src_matrix = mu.calculate_sparse_b_src_matrix(
+                self.basis,
+                self.grid_positions(),
+                self.source_positions(),
                 self.R
             )
-
-        self.b_src_matrix = self.b_src_matrix.reshape(ng, n)
+        elif bf.is_separable(self.basis):
+            self.b_src_matrix = mu.calculate_separable_b_src_matrix(
+                self.basis,
+                self.grid_axes(),
+                self.source_axes(),
+                self.R
+            )
+        else:
+            self.b_src_matrix = mu.calculate_b_src_matrix(
+                self.basis,
+                self.grid_positions(),
+                self.source_positions(),
+                self.R,
+                self.mem_budget
+            )
 
     def calculate_b_interp_pot_matrix(self):
         """
@@ -307,30 +300,64 @@ class KCSD3D(object):
         self.make_b_interp_pot_matrix_3D()
 
     def make_b_interp_pot_matrix_3D(self):
-        (ngx, ngy, ngz) = self.space_X.shape
-        ng = ngx * ngy * ngz
-        (nsx, nsy, nsz) = self.X_src.shape
-        n_src = nsy * nsx * nsz
-
-        self.b_interp_pot_matrix = np.zeros((ngx, ngy, ngz, n_src))
-
-        for i in range(0, n_src):
-            # getting the coordinates of the i-th source
-            i_x, i_y, i_z = np.unravel_index(i, (nsx, nsy, nsz), order='F')
-            z_src = self.Z_src[i_x, i_y, i_z]
-            y_src = self.Y_src[i_x, i_y, i_z]
-            x_src = self.X_src[i_x, i_y, i_z]
-            norms = np.sqrt((self.space_X - x_src)**2
-                            + (self.space_Y - y_src)**2
-                            + (self.space_Z - z_src)**2)
-
-            self.b_interp_pot_matrix[:, :, :, i] = dt.generated_potential(
-                norms,
-                self.dist_max,
-                self.dist_table
-            )
+        """
+        Calculate b_interp_pot_matrix
+        """
+        self.b_interp_pot_matrix = mu.calculate_b_interp_pot_matrix(
+            self.grid_positions(),
+            self.source_positions(),
+            self.dist_max,
+            self.potential_lookup(),
+            self.mem_budget
+        )
 
-        self.b_interp_pot_matrix = self.b_interp_pot_matrix.reshape(ng, n_src)
+    def grid_coordinates(self):
+        """
+        Returns the coordinates of the estimation space stored with
+        the results.
+        """
+        return {
+            'space_X': self.space_X,
+            'space_Y': self.space_Y,
+            'space_Z': self.space_Z,
+        }
+
+    def grid_positions(self):
+        """
+        Returns the points of the estimation space (n_grid x 3),
+        flattened in C order.
+        """
+        return np.column_stack((self.space_X.ravel(),
+                                self.space_Y.ravel(),
+                                self.space_Z.ravel()))
+
+    def source_positions(self, order='F'):
+        """
+        Returns the positions of the sources (n_src x 3).
+        Sources are numbered in Fortran order in b_src_matrix and
+        b_interp_pot_matrix and in C order in b_pot_matrix.
+        """
+        return np.column_stack((self.X_src.ravel(order=order),
+                                self.Y_src.ravel(order=order),
+                                self.Z_src.ravel(order=order)))
+
+    def grid_axes(self):
+        """
+        Returns (coordinate, values) for every axis of the estimation grid.
+        The grid comes from np.meshgrid, so its axes are (y, x, z).
+        """
+        return [(1, self.space_Y[:, 0, 0]),
+                (0, self.space_X[0, :, 0]),
+                (2, self.space_Z[0, 0, :])]
+
+    def source_axes(self):
+        """
+        Returns (coordinate, values) for every axis of the source lattice,
+        in the order of the Fortran order numbering of sources: (z, x, y).
+        """
+        return [(2, self.Z_src[0, 0, :]),
+                (0, self.X_src[0, :, 0]),
+                (1, self.Y_src[:, 0, 0])]
 
 
 def main():
@@ -354,4 +381,4 @@ def main():
 
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
@@ -157,14 +157,72 @@ def step_rescale_3D(xp, yp, zp, mu, R):
 
     **Parameters**
 
-    xp, yp : floats or np.arrays
+    xp, yp, zp : floats or np.arrays
         point or set of points where function should be calculated
     
-    mu : float
+    mu : list
         origin of the function
     
     R : float
         cutoff range
     """
-    s = 3/(4*pi*R**3)*(xp**2 + yp**2 + zp**2 <= R**2)
+    s = ((xp-mu[0])**2 + (yp-mu[1])**2 + (zp-mu[2])**2 <= R**2)
+    s = 3/(4*pi*R**3) * s
     return s
+
+
+# basis functions which are equal to zero farther than R from their center
+COMPACT_BASES = (
+    gauss_rescale_lim_1D,
+    step_rescale_1D,
+    gauss_rescale_lim_2D,
+    step_rescale_2D,
+    gauss_rescale_lim_3D,
+    step_rescale_3D,
+)
+
+
+def has_compact_support(basis):
+    """
+    Checks if the basis function vanishes farther than R from its center.
+    """
+    return basis in COMPACT_BASES
+
+
+# basis functions which are products of functions of single coordinates
+SEPARABLE_BASES = (
+    gauss_rescale_2D,
+    gauss_rescale_3D,
+)
+
+
+def is_separable(basis):
+    """
+    Checks if the basis function is a product of functions
+    of single coordinates.
+    """
+    return basis in SEPARABLE_BASES
+
+
+# number of coordinates of the basis functions
+DIMENSIONS = {
+    gauss_rescale_1D: 1,
+    gauss_rescale_lim_1D: 1,
+    step_rescale_1D: 1,
+    gauss_rescale_2D: 2,
+    gauss_rescale_lim_2D: 2,
+    step_rescale_2D: 2,
+    gauss_rescale_3D: 3,
+    gauss_rescale_lim_3D: 3,
+    step_rescale_3D: 3,
+}
+
+
+def center_value(basis, R):
+    """
+    Returns the value of the basis function of radius R at its center.
+    """
+    dim = DIMENSIONS[basis]
+    if dim == 1:
+        return basis(0.0, 0.0, R)
+    return basis(*([0.0] * dim + [[0.0] * dim, R]))
@@ -0,0 +1,212 @@
+# -*- coding: utf-8 -*-
+from __future__ import division
+
+import numpy as np
+from numpy.fft import rfftn, irfftn
+
+from . import dist_table_utils as dt
+from . import matrix_utils as mu
+
+"""
+This module contains routines computing k_interp_cross and interp_pot
+as convolutions, for sources placed on the lattice of the estimation space.
+
+Both the basis functions and the potentials they generate depend only on
+the offset between a point and the source. When the sources and the
+estimation points lie on the nodes of a common lattice, the product of
+b_src_matrix (or b_interp_pot_matrix) and b_pot_matrix is a convolution
+of the sources weighted by b_pot_matrix with a single kernel, which is
+evaluated with FFT. The n_grid x n_src matrices are never formed.
+The kernels are evaluated at exact lattice offsets, see
+calculate_interp_pot() for how this affects the dist_table lookup.
+"""
+
+# largest distance from a lattice node, relative to the lattice spacing,
+# of a point which is still considered to lie on the node
+LATTICE_TOLERANCE = 1e-6
+
+# largest number of lattice nodes per estimation grid step, the lattice
+# is refined when the sources lie between the grid points
+MAX_LATTICE_REFINEMENT = 4
+
+
+def find_lattice(grid_pos, src_pos, tol=LATTICE_TOLERANCE):
+    """
+    Checks if the estimation points and the sources lie on the nodes
+    of a common regular lattice. The lattice is spaced like the estimation
+    grid, or a few times finer if the sources lie between the grid points.
+
+    **Parameters**
+
+    grid_pos : np.array
+        points of the estimation space (n_grid x dim)
+
+    src_pos : np.array
+        positions of the sources (n_src x dim)
+
+    **Returns**
+
+    lattice : tuple or None
+        (spacing, grid_idx, src_idx) - spacing of the lattice in every
+        direction and lattice indices of the estimation points and the
+        sources, None if the points do not share a lattice
+    """
+    dim = grid_pos.shape[1]
+    origin = np.min(grid_pos, axis=0)
+    spacing = np.empty(dim)
+    grid_idx = np.empty(grid_pos.shape, dtype=int)
+    src_idx = np.empty(src_pos.shape, dtype=int)
+    for d in range(dim):
+        coords = np.unique(grid_pos[:, d])
+        if len(coords) < 2:
+            return None
+        steps = np.diff(coords)
+        grid_step = np.mean(steps)
+        if np.max(np.abs(steps - grid_step)) > tol * grid_step:
+            return None
+        for refinement in range(1, MAX_LATTICE_REFINEMENT + 1):
+            spacing[d] = grid_step / refinement
+            grid_d = _lattice_indices(grid_pos[:, d] - origin[d],
+                                      spacing[d], tol)
+            src_d = _lattice_indices(src_pos[:, d] - origin[d],
+                                     spacing[d], tol)
+            if grid_d is not None and src_d is not None:
+                break
+        else:
+            return None
+        grid_idx[:, d] = grid_d
+        src_idx[:, d] = src_d
+    return (spacing, grid_idx, src_idx)
+
+
+def _lattice_indices(coords, spacing, tol):
+    idx = coords / spacing
+    rounded = np.round(idx)
+    if np.max(np.abs(idx - rounded)) > tol:
+        return None
+    return rounded.astype(int)
+
+
+def calculate_k_interp_cross(basis, lattice, R, b_pot_matrix):
+    """
+    Computes k_interp_cross = b_src_matrix * b_pot_matrix as a convolution.
+
+    **Parameters**
+
+    basis : callable
+        basis function template
+
+    lattice : tuple
+        lattice of the estimation space and sources, from find_lattice()
+
+    R : float
+        basis function radius
+
+    b_pot_matrix : np.array
+        potentials of the sources at the electrodes (n_src x n_elec)
+
+    **Returns**
+
+    k_interp_cross : np.array
+        cross kernel of the estimation space and electrodes (n_grid x n_elec)
+    """
+    def kernel_func(offsets):
+        center = np.zeros(offsets.shape[-1])
+        return mu.evaluate_basis(basis, offsets, center, R)
+    return convolve(kernel_func, lattice, b_pot_matrix)
+
+
+def calculate_interp_pot(lattice, dist_max, dist_table, b_pot_matrix):
+    """
+    Computes interp_pot = b_interp_pot_matrix * b_pot_matrix
+    as a convolution.
+
+    The distances are computed from the lattice offsets, so they differ
+    from the distances between the points by a few ulps. With a nearest
+    sample dist_table a distance close to the boundary between two samples
+    may be looked up in the other sample, so the result agrees with
+    the matrix path only up to the dist_table resolution. Interpolating
+    lookups (e.g. make_lookup(..., 'spline')) agree up to rounding.
+
+    **Parameters**
+
+    lattice : tuple
+        lattice of the estimation space and sources, from find_lattice()
+
+    dist_max : float
+        distance between two most distant points in estimation space
+
+    dist_table : np.array
+        potential as a probed function of distance
+
+    b_pot_matrix : np.array
+        potentials of the sources at the electrodes (n_src x n_elec)
+
+    **Returns**
+
+    interp_pot : np.array
+        potential kernel of the estimation space and electrodes
+        (n_grid x n_elec)
+    """
+    def kernel_func(offsets):
+        dists = np.sqrt(np.sum(offsets**2, axis=-1))
+        return dt.generated_potential(np.minimum(dists, dist_max), dist_max,
+                                      dist_table)
+    return convolve(kernel_func, lattice, b_pot_matrix)
+
+
+def convolve(kernel_func, lattice, weights):
+    """
+    Computes sum_j kernel(x_i - s_j) * weights[j] for all the estimation
+    points x_i and sources s_j lying on the lattice.
+
+    **Parameters**
+
+    kernel_func : callable
+        kernel as a function of offsets, which are given as an array
+        with coordinates in the last axis
+
+    lattice : tuple
+        lattice of the estimation space and sources, from find_lattice()
+
+    weights : np.array
+        weights of the sources (n_src x k)
+
+    **Returns**
+
+    result : np.array
+        convolution in the estimation points (n_grid x k)
+    """
+    (spacing, grid_idx, src_idx) = lattice
+    lo = np.minimum(grid_idx.min(axis=0), src_idx.min(axis=0))
+    grid_idx = tuple((grid_idx - lo).T)
+    src_idx = tuple((src_idx - lo).T)
+    shape = tuple(np.maximum(np.max(grid_idx, axis=1),
+                             np.max(src_idx, axis=1)) + 1)
+
+    # circular convolution of this size does not wrap around any of the
+    # offsets between a source and an estimation point
+    fft_shape = tuple(2 * n - 1 for n in shape)
+    offsets = np.meshgrid(*[_circular_offsets(n) * h
+                            for (n, h) in zip(shape, spacing)],
+                          indexing='ij')
+    kernel = kernel_func(np.stack(offsets, axis=-1))
+    kernel_fft = rfftn(kernel, fft_shape)
+
+    result = np.empty((len(grid_idx[0]), weights.shape[1]))
+    for k in range(weights.shape[1]):
+        source_map = np.zeros(shape)
+        np.add.at(source_map, src_idx, weights[:, k])
+        conv = irfftn(rfftn(source_map, fft_shape) * kernel_fft, fft_shape)
+        result[:, k] = conv[grid_idx]
+    return result
+
+
+def _circular_offsets(n):
+    """
+    Returns the offsets -(n-1)...(n-1) in the order of a circular
+    convolution of size 2n-1.
+    """
+    offsets = np.arange(2 * n - 1)
+    offsets[n:] -= 2 * n - 1
+    return offsets
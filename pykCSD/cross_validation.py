@@ -2,13 +2,17 @@ import numpy as np
 from numpy import dot, identity
 from numpy.linalg import norm, inv
 
+from . import estimation_utils as eu
+from . import dist_table_utils as dt
+
 """
 This module contains routines for cross validation, which is used
 to find the regularization parameter in the KCSD method
 """
 
 
-def choose_lambda(lambdas, sampled_pots, k_pot, elec_pos, index_generator):
+def choose_lambda(lambdas, sampled_pots, k_pot, elec_pos,
+                  index_generator=None, n_jobs=1):
     """
     Finds the optimal regularization parameter lambda
     for Tikhonov regularization using cross validation.
@@ -18,7 +22,7 @@ def choose_lambda(lambdas, sampled_pots, k_pot, elec_pos, index_generator):
     lambdas: list-like
         regularization parameters set to choose from
     
-    index_generator: callable
+    index_generator: callable, optional
         generator of training and testing indices, for example:
 
         from sklearn.cross_validation import KFold, LeaveOneOut, ShuffleSplit
@@ -27,36 +31,114 @@ def choose_lambda(lambdas, sampled_pots, k_pot, elec_pos, index_generator):
         index_generator = ShuffleSplit(5, n_iter=15, test_size=0.25, indices=True)
         index_generator = LeavePOut(n, 2)
         index_generator = LeaveOneOut(n_elec, indices=True)
+
+        if omitted, leave-one-out errors are computed in closed form
+        from a single factorization of k_pot
+
+    n_jobs: int, optional
+        number of threads evaluating the folds (or the lambdas
+        in the closed-form leave-one-out), the result does not
+        depend on it
     """
-    n = len(lambdas)
-    errors = np.zeros(n)
-    for i, lambd in enumerate(lambdas):
-        errors[i] = cross_validation(
-            lambd,
-            sampled_pots,
-            k_pot,
-            index_generator
-        )
+    if index_generator is None:
+        factorization = eu.factorize(k_pot)
+
+        def loo_error(lambd):
+            return loo_cross_validation(lambd, sampled_pots, k_pot,
+                                        factorization)
+        errors = np.array(parallel_map(loo_error, lambdas, n_jobs))
+    else:
+        errors = cross_validation_path(lambdas, sampled_pots, k_pot,
+                                       index_generator, n_jobs)
     return lambdas[errors == min(errors)][0]
 
 
-def cross_validation(lambd, pot, k_pot, index_generator):
+def cross_validation(lambd, pot, k_pot, index_generator, n_jobs=1):
     """
     Calculate error using LeaveOneOut or KFold cross validation.
+    The folds are evaluated by n_jobs threads.
     """
-    errors = []
+    def fold_error(fold):
+        (ind_train, ind_test) = fold
+        return calc_CV_error(lambd, pot, k_pot, ind_test, ind_train)
 
-    for ind_train, ind_test in index_generator:
-        err = calc_CV_error(lambd, pot, k_pot, ind_test, ind_train)
-        errors.append(err)
+    errors = parallel_map(fold_error, list(index_generator), n_jobs)
 
     error = np.mean(errors)
     # print "l=", lambd, ", err=", error
     return error
 
 
+def cross_validation_path(lambdas, pot, k_pot, index_generator, n_jobs=1):
+    """
+    Calculate cross validation errors for all the lambdas at once.
+
+    The training kernel of every fold is eigendecomposed once, and
+    the predictions for every lambda are obtained by rescaling its
+    eigenvalues, so the cost hardly depends on the number of lambdas.
+    The errors are the same as of cross_validation() for each lambda.
+    The folds are evaluated by n_jobs threads.
+    """
+    def fold_errors(fold):
+        (ind_train, ind_test) = fold
+        return calc_CV_errors(lambdas, pot, k_pot, ind_test, ind_train)
+
+    errors = parallel_map(fold_errors, list(index_generator), n_jobs)
+    return np.mean(errors, axis=0)
+
+
+def calc_CV_errors(lambdas, pot, k_pot, ind_test, ind_train):
+    """
+    Calculate errors of a single fold for all the lambdas
+    from an eigendecomposition of the training kernel.
+    """
+    lambdas = np.asarray(lambdas, dtype=float)
+    factorization = eu.KernelFactorization(
+        k_pot[np.ix_(ind_train, ind_train)])
+    v = factorization.eigenvectors
+
+    n_elec = k_pot.shape[0]
+    pot = np.asarray(pot).reshape(n_elec, -1)
+    pot_test = pot[ind_test]
+    k_cross = k_pot[np.ix_(ind_test, ind_train)]
+
+    cross_v = dot(k_cross, v)
+    pot_v = dot(v.T, pot[ind_train])
+    # the lambdas are evaluated one by one, so that only one estimation
+    # (n_test x nt) is held in memory at a time
+    errors = np.empty(len(lambdas))
+    for (i, lambd) in enumerate(lambdas):
+        pot_est = dot(cross_v / (factorization.eigenvalues + lambd), pot_v)
+        errors[i] = norm(pot_test - pot_est)
+    # if the matrix is not invertible, then return a high error
+    errors[~np.isfinite(errors)] = 100000
+    return errors
+
+
+def loo_cross_validation(lambd, pot, k_pot, factorization=None):
+    """
+    Calculate leave-one-out cross validation error without refitting
+    the model for every left out electrode.
+
+    For ridge regression with A = inv(k_pot + lambd * I) the residual
+    of the prediction for electrode i from all the other electrodes
+    equals (A * pot)_i / A_ii, so all the folds are evaluated with
+    one factorization of k_pot (which may be passed to be reused).
+    The error is the same as of cross_validation() with LeaveOneOut.
+    """
+    factorization = eu.factorize(k_pot, factorization)
+    n_elec = k_pot.shape[0]
+    residuals = factorization.solve(lambd, pot).reshape(n_elec, -1)
+    residuals /= factorization.inverse_diagonal(lambd)[:, np.newaxis]
+    errors = norm(residuals, axis=1)
+    if not np.all(np.isfinite(errors)):
+        # if the matrix is not invertible, then return a high error
+        return 100000
+    return np.mean(errors)
+
+
 def calc_CV_error(lambd, pot, k_pot, ind_test, ind_train):
-    k_train = k_pot[ind_train, ind_train]
+    k_train = k_pot[np.ix_(ind_train, ind_train)]
 
     pot_train = pot[ind_train]
     pot_test = pot[ind_test]
@@ -75,3 +157,15 @@ def calc_CV_error(lambd, pot, k_pot, ind_test, ind_train):
 
     err = norm(pot_test - pot_est)
     return err
+
+
+def parallel_map(func, items, n_jobs=1):
+    """
+    Returns [func(item) for item in items], computed by n_jobs threads.
+    The threads share k_pot and the potentials without copying them,
+    and the results are kept in the order of items, so that they are
+    combined exactly as in the serial run.
+    """
+    if n_jobs == 1:
+        return [func(item) for item in items]
+    return dt.get_pool(n_jobs, 'thread').map(func, items)
@@ -1,11 +1,38 @@
 # -*- coding: utf-8 -*-
 from __future__ import division
 
+import os
+import sys
+import json
+import atexit
+import hashlib
+import tempfile
+from functools import partial
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
+
 import numpy as np
-from scipy.interpolate import interp1d
+from scipy.interpolate import interp1d, CubicSpline
+
+EXECUTORS = {
+    'thread': ThreadPool,
+    'process': Pool,
+}
+
+# worker pools are created once and reused by all the tables
+_pools = {}
+
+# default limit (in bytes) of the on-disk cache of distance tables
+CACHE_SIZE = 2**28
+
+# largest relative difference of the steps of two tables, which still
+# allows to reuse one of them as the other
+CACHE_STEP_TOLERANCE = 1e-12
 
 
-def create_dist_table(basis, pot_func, R, h, sigma, dist_max, dt_len):
+def create_dist_table(basis, pot_func, R, h, sigma, dist_max, dt_len,
+                      vectorized=False, n_jobs=1, executor='thread',
+                      cache_dir=None, cache_size=CACHE_SIZE):
     """
     Create table of a single source base element contribution
     to overall potential as a function of distance.
@@ -36,19 +63,304 @@ def create_dist_table(basis, pot_func, R, h, sigma, dist_max, dt_len):
     
     dt_len : float
         number of points in distance table
+
+    vectorized : bool, optional
+        if True, pot_func accepts an array of distances and is evaluated
+        exactly at every point of the table, instead of being probed
+        and interpolated
+
+    n_jobs : int, optional
+        number of workers sharing the probed distances
+
+    executor : str, optional
+        type of the workers ('thread' or 'process'), with processes
+        pot_func and basis have to be picklable (module level functions)
+
+    cache_dir : str, optional
+        directory of the on-disk cache of distance tables, the table is
+        loaded from there if it was already computed with the same
+        parameters (or computed for a larger dist_max with the same step);
+        tables of a pot_func or basis which is not a module level function
+        (e.g. a lambda or a local function) are never cached, as they
+        cannot be told apart by name
+
+    cache_size : int, optional
+        limit (in bytes) of the cache size, the least recently used
+        tables are removed when it is exceeded
     """
-    xs = probe_dist_table_points(R, dist_max, dt_len)
+    if cache_dir is not None and is_cacheable(basis, pot_func):
+        meta = cache_metadata(basis, pot_func, R, h, sigma, dist_max,
+                              dt_len, vectorized)
+        dist_table = load_cached_dist_table(cache_dir, meta)
+        if dist_table is None:
+            dist_table = create_dist_table(basis, pot_func, R, h, sigma,
+                                           dist_max, dt_len, vectorized,
+                                           n_jobs, executor)
+            store_cached_dist_table(cache_dir, meta, dist_table, cache_size)
+        return dist_table
+
+    probe = partial(_probe_potential, pot_func, R, h, sigma, basis)
 
-    dist_table = np.zeros(len(xs))
+    if vectorized:
+        pos = np.arange(dt_len)/dt_len * dist_max
+        if n_jobs == 1:
+            return probe(pos)
+        chunks = np.array_split(pos, n_jobs)
+        return np.concatenate(get_pool(n_jobs, executor).map(probe, chunks))
 
-    for i, x in enumerate(xs):
-        pos = (x/dt_len) * dist_max
-        dist_table[i] = pot_func(pos, R, h, sigma, basis)
+    xs = probe_dist_table_points(R, dist_max, dt_len)
+    pos = (xs/dt_len) * dist_max
+
+    if n_jobs == 1:
+        dist_table = np.array([probe(x) for x in pos])
+    else:
+        dist_table = np.array(get_pool(n_jobs, executor).map(probe, pos))
 
     dist_table = interpolate_dist_table(xs, dist_table, dt_len)
     return dist_table
 
 
+def fixed_step_table(dist_max, step):
+    """
+    Returns (dt_len, dist_max) of a table sampled every step, covering
+    at least the given dist_max. The tables of the same step computed for
+    different dist_max are truncations of each other, so the cache serves
+    the shorter ones from the longer ones.
+    """
+    dt_len = int(np.ceil(dist_max / step))
+    return (dt_len, dt_len * step)
+
+
+def _probe_potential(pot_func, R, h, sigma, basis, pos):
+    return pot_func(pos, R, h, sigma, basis)
+
+
+def get_pool(n_jobs, executor='thread'):
+    """
+    Returns a pool of n_jobs workers of the given type, which is created
+    at the first call and reused afterwards.
+    """
+    if executor not in EXECUTORS:
+        raise Exception("Incorrect executor type!")
+    if n_jobs < 1:
+        raise Exception("Number of jobs must be a positive integer!")
+    key = (executor, n_jobs)
+    if key not in _pools:
+        _pools[key] = EXECUTORS[executor](n_jobs)
+    return _pools[key]
+
+
+@atexit.register
+def close_pools():
+    """
+    Stops all the worker pools.
+    """
+    for pool in _pools.values():
+        pool.close()
+        pool.join()
+    _pools.clear()
+
+
+def is_cacheable(*funcs):
+    """
+    Checks if the functions are identified by their module and name,
+    which the cache keys are built from. Partials are checked together
+    with their callable arguments.
+    """
+    for func in funcs:
+        if isinstance(func, partial):
+            args = list(func.args) + list((func.keywords or {}).values())
+            if not is_cacheable(func.func, *[arg for arg in args
+                                             if callable(arg)]):
+                return False
+        elif not _is_module_attribute(func):
+            return False
+    return True
+
+
+def _is_module_attribute(func):
+    # lambdas, local functions and callable objects share their names
+    # with other callables, so they are not found under it in the module
+    module = sys.modules.get(getattr(func, '__module__', None))
+    name = getattr(func, '__qualname__', getattr(func, '__name__', None))
+    if module is None or name is None:
+        return False
+    obj = module
+    for part in name.split('.'):
+        obj = getattr(obj, part, None)
+    return obj is func
+
+
+def cache_metadata(basis, pot_func, R, h, sigma, dist_max, dt_len,
+                   vectorized):
+    """
+    Describes the distance table in the cache. The 'family' entry
+    identifies the tables that differ only in dist_max and dt_len,
+    'key' identifies the table itself.
+    """
+    meta = {
+        'basis': _callable_name(basis),
+        'pot_func': _callable_name(pot_func),
+        'R': float(R),
+        'h': float(h),
+        'sigma': float(sigma),
+        'vectorized': bool(vectorized),
+    }
+    meta['family'] = _hash(meta)
+    meta['dist_max'] = float(dist_max)
+    meta['dt_len'] = int(dt_len)
+    meta['key'] = _hash(meta)
+    return meta
+
+
+def load_cached_dist_table(cache_dir, meta):
+    """
+    Loads the distance table described by meta from the cache.
+    Exactly evaluated (vectorized) tables are also obtained by truncating
+    a longer table of the same family computed with the same step.
+
+    **Returns**
+
+    dist_table : np.array or None
+        the table, None if it is not in the cache
+    """
+    fname = _cache_path(cache_dir, meta['key'])
+    if os.path.exists(fname):
+        return _load_cache_entry(fname)
+    if not meta['vectorized'] or not os.path.isdir(cache_dir):
+        return None
+
+    step = meta['dist_max'] / meta['dt_len']
+    best = None
+    for entry in os.listdir(cache_dir):
+        if not entry.endswith('.json'):
+            continue
+        try:
+            with open(os.path.join(cache_dir, entry)) as f:
+                other = json.load(f)
+        except (IOError, OSError, ValueError):
+            continue
+        if other.get('family') != meta['family']:
+            continue
+        other_step = other['dist_max'] / other['dt_len']
+        if (other['dt_len'] >= meta['dt_len'] and
+                abs(other_step - step) <= CACHE_STEP_TOLERANCE * step):
+            if best is None or other['dt_len'] < best['dt_len']:
+                best = other
+    if best is None:
+        return None
+    dist_table = _load_cache_entry(_cache_path(cache_dir, best['key']))
+    if dist_table is None:
+        return None
+    return dist_table[:meta['dt_len']].copy()
+
+
+def store_cached_dist_table(cache_dir, meta, dist_table,
+                            cache_size=CACHE_SIZE):
+    """
+    Stores the distance table in the cache and removes the least
+    recently used tables if the cache exceeds cache_size bytes.
+    """
+    try:
+        os.makedirs(cache_dir)
+    except OSError:
+        # the directory exists, possibly created by a concurrent process
+        if not os.path.isdir(cache_dir):
+            raise
+    fname = _cache_path(cache_dir, meta['key'])
+
+    # the files are renamed only when complete, so that concurrent
+    # processes never read partially written tables
+    (fd, tmp) = tempfile.mkstemp(dir=cache_dir, suffix='.tmp')
+    with os.fdopen(fd, 'wb') as f:
+        np.save(f, dist_table)
+    os.rename(tmp, fname)
+    (fd, tmp) = tempfile.mkstemp(dir=cache_dir, suffix='.tmp')
+    with os.fdopen(fd, 'w') as f:
+        json.dump(meta, f, indent=4, sort_keys=True)
+    os.rename(tmp, os.path.splitext(fname)[0] + '.json')
+
+    evict_cache(cache_dir, cache_size, keep=meta['key'])
+
+
+def evict_cache(cache_dir, cache_size=CACHE_SIZE, keep=None):
+    """
+    Removes the least recently used tables (by modification time, which
+    is updated whenever a table is loaded) until the size of the cache
+    does not exceed cache_size bytes. The table with the key keep is
+    never removed.
+    """
+    entries = []
+    total = 0
+    for entry in os.listdir(cache_dir):
+        (key, ext) = os.path.splitext(entry)
+        if ext != '.npy':
+            continue
+        try:
+            stat = os.stat(os.path.join(cache_dir, entry))
+        except OSError:
+            continue
+        size = stat.st_size
+        meta_fname = os.path.join(cache_dir, key + '.json')
+        if os.path.exists(meta_fname):
+            size += os.path.getsize(meta_fname)
+        entries.append((stat.st_mtime, key, size))
+        total += size
+
+    for (mtime, key, size) in sorted(entries):
+        if total <= cache_size:
+            break
+        if key == keep:
+            continue
+        for ext in ('.npy', '.json'):
+            try:
+                os.remove(os.path.join(cache_dir, key + ext))
+            except OSError:
+                pass
+        total -= size
+
+
+def _load_cache_entry(fname):
+    try:
+        dist_table = np.load(fname)
+    except (IOError, OSError, ValueError):
+        return None
+    # loading counts as a use of the table for the eviction,
+    # a read-only cache still serves the table
+    try:
+        os.utime(fname, None)
+    except OSError:
+        pass
+    return dist_table
+
+
+def _cache_path(cache_dir, key):
+    return os.path.join(cache_dir, key + '.npy')
+
+
+def _callable_name(func):
+    if isinstance(func, partial):
+        args = [_argument_name(arg) for arg in func.args]
+        keywords = sorted((func.keywords or {}).items())
+        args += ['%s=%s' % (key, _argument_name(value))
+                 for (key, value) in keywords]
+        return '%s(%s)' % (_callable_name(func.func), ', '.join(args))
+    return '%s.%s' % (func.__module__, func.__name__)
+
+
+def _argument_name(arg):
+    # the repr of functions contains their address, which differs
+    # between processes
+    if callable(arg):
+        return _callable_name(arg)
+    return repr(arg)
+
+
+def _hash(meta):
+    text = json.dumps(meta, sort_keys=True)
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+
 def probe_dist_table_points(R, dist_max, dt_len):
     """
     Helps to choose important points in the distance table to probe
@@ -99,9 +411,7 @@ def interpolate_dist_table(xs, probed_dist_table, dt_len):
         kind='cubic',
         fill_value=0.0
     )
-    dt_int = np.array([inter(i) for i in range(dt_len)])
-    dt_int.flatten()
-    return dt_int
+    return inter(np.arange(dt_len))
 
 
 def generated_potential(dist, dist_max, dist_table):
@@ -114,17 +424,66 @@ def generated_potential(dist, dist_max, dist_table):
     dist_max : float
         distance between two most distant points in estimation space
     
-    dist_table : np.array
-        potential as a probed function of distance
+    dist_table : np.array or DistTableLookup
+        potential as a probed function of distance, an array is read
+        at the nearest sample and a DistTableLookup interpolates
+        between the samples
 
     **Returns**
 
     pot : float
         value of potential at specified distance from the source
     """
+    if isinstance(dist_table, DistTableLookup):
+        return dist_table(dist)
     dt_len = len(dist_table)
-    indices = np.uint16(np.round(dt_len * dist/dist_max))
+    indices = np.round(dt_len * np.asarray(dist)/dist_max).astype(np.intp)
     ind = np.maximum(0, np.minimum(indices, dt_len-1))
 
     pot = dist_table[ind]
     return pot
+
+
+class DistTableLookup(object):
+    """
+    Potential as a function of distance given by a cubic spline through
+    the samples of a distance table. Unlike the nearest sample lookup
+    it interpolates between the samples, so a much shorter table gives
+    the same accuracy, and it is evaluated at once for arrays of
+    distances of any size.
+    """
+
+    def __init__(self, dist_table, dist_max):
+        """
+        **Parameters**
+
+        dist_table : np.array
+            potential sampled at distances i * dist_max/len(dist_table)
+
+        dist_max : float
+            distance between two most distant points in estimation space
+        """
+        dt_len = len(dist_table)
+        dists = np.arange(dt_len)/dt_len * dist_max
+        self.dist_last = dists[-1]
+        self.spline = CubicSpline(dists, dist_table)
+
+    def __call__(self, dist):
+        # beyond the last sample the potential is extended by a constant,
+        # as in the nearest sample lookup
+        dist = np.minimum(np.abs(dist), self.dist_last)
+        return self.spline(dist)
+
+
+def make_lookup(dist_table, dist_max, kind='nearest'):
+    """
+    Returns the object evaluating potentials from the distance table:
+    the table itself for 'nearest' sample lookup, or DistTableLookup
+    for 'spline' interpolation.
+    """
+    if kind == 'nearest':
+        return dist_table
+    elif kind == 'spline':
+        return DistTableLookup(dist_table, dist_max)
+    else:
+        raise Exception("Incorrect dist_lookup type!")
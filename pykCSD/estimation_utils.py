@@ -0,0 +1,417 @@
+# -*- coding: utf-8 -*-
+from __future__ import division
+
+import numpy as np
+from numpy import dot
+from numpy.linalg import eigh
+
+from . import basis_functions as bf
+from . import dist_table_utils as dt
+from . import matrix_utils as mu
+from . import convolution_utils as cu
+from . import storage_utils as su
+
+"""
+This module contains routines shared by the 1D, 2D and 3D solvers
+for estimating CSD and potentials from the measured potentials,
+and the KCSDBase class which the solvers derive from.
+"""
+
+
+class KernelFactorization(object):
+    """
+    Symmetric eigendecomposition of the k_pot kernel matrix.
+
+    Once k_pot = V * diag(w) * V.T is known, the ridge regression system
+    (k_pot + lambd * I) beta = pots can be solved for any lambda with
+    a diagonal rescale and two matrix products. The estimation operators
+    built from the factorization are cached for the last used lambda.
+
+    **Parameters**
+
+    k_pot : np.array
+        kernel matrix of the electrodes (n_elec x n_elec)
+    """
+
+    def __init__(self, k_pot):
+        self.k_pot = np.array(k_pot, dtype=float)
+        self.eigenvalues, self.eigenvectors = eigh(self.k_pot)
+        self._operators = {}
+
+    def is_valid_for(self, k_pot):
+        """Checks if the factorization still describes k_pot."""
+        return (self.k_pot.shape == k_pot.shape and
+                np.array_equal(self.k_pot, k_pot))
+
+    def inverse(self, lambd):
+        """Returns inv(k_pot + lambd * I)."""
+        v = self.eigenvectors
+        return dot(v / (self.eigenvalues + lambd), v.T)
+
+    def inverse_diagonal(self, lambd):
+        """Returns the diagonal of inv(k_pot + lambd * I)."""
+        v = self.eigenvectors
+        return np.sum(v**2 / (self.eigenvalues + lambd), axis=1)
+
+    def solve(self, lambd, pots):
+        """Returns inv(k_pot + lambd * I) * pots."""
+        v = self.eigenvectors
+        scale = 1.0 / (self.eigenvalues + lambd)
+        pots_v = dot(v.T, pots)
+        pots_v *= scale.reshape((-1,) + (1,) * (pots_v.ndim - 1))
+        return dot(v, pots_v)
+
+    def operator(self, lambd, estimation_table):
+        """
+        Returns estimation_table * inv(k_pot + lambd * I), the linear map
+        from the electrode space to the estimation space.
+        """
+        key = (lambd, id(estimation_table))
+        if key in self._operators:
+            table, operator = self._operators[key]
+            if table is estimation_table:
+                return operator
+        self._operators = dict((k, v) for (k, v) in self._operators.items()
+                               if k[0] == lambd)
+        v = self.eigenvectors
+        operator = dot(dot(estimation_table, v) / (self.eigenvalues + lambd),
+                       v.T)
+        self._operators[key] = (estimation_table, operator)
+        return operator
+
+
+def factorize(k_pot, factorization=None):
+    """
+    Returns the cached factorization of k_pot if it is still valid,
+    otherwise computes a new one.
+    """
+    if factorization is None or not factorization.is_valid_for(k_pot):
+        factorization = KernelFactorization(k_pot)
+    return factorization
+
+
+def estimate(operator, sampled_pots, chunk_size=1000):
+    """
+    Estimates CSD or potentials for all time samples at once.
+
+    Potentials which are not held in memory (np.memmap, HDF5 datasets)
+    are read lazily in time chunks.
+
+    **Parameters**
+
+    operator : np.array
+        estimation operator (n_grid x n_elec)
+
+    sampled_pots : np.array, np.memmap or h5py.Dataset
+        potentials measured by electrodes (n_elec x nt)
+
+    chunk_size : int, optional
+        number of time samples read at once from on-disk potentials
+
+    **Returns**
+
+    estimation : np.array
+        estimated values in the flattened estimation space (n_grid x nt)
+    """
+    if is_in_memory(sampled_pots):
+        sampled_pots = np.asarray(sampled_pots, dtype=float)
+        estimation = dot(operator, sampled_pots)
+        return estimation
+
+    nt = sampled_pots.shape[1]
+    estimation = np.empty((operator.shape[0], nt))
+    start = 0
+    for pots_chunk in iterate_chunks(sampled_pots, chunk_size):
+        stop = start + pots_chunk.shape[1]
+        estimation[:, start:stop] = dot(operator, pots_chunk)
+        start = stop
+    return estimation
+
+
+def is_in_memory(pots):
+    """
+    Checks if the potentials are held in memory, as opposed to
+    memory-mapped arrays and HDF5 datasets which are read on demand.
+    """
+    return (not isinstance(pots, np.memmap) and
+            (isinstance(pots, np.ndarray) or not hasattr(pots, 'shape')))
+
+
+def iterate_chunks(pots, chunk_size):
+    """
+    Yields consecutive time chunks of the potentials.
+
+    **Parameters**
+
+    pots : np.array
+        potentials measured by electrodes (n_elec x nt)
+
+    chunk_size : int
+        number of time samples in a chunk
+    """
+    if chunk_size < 1:
+        raise Exception("Chunk size must be a positive integer!")
+    return _iterate_chunks(pots, chunk_size)
+
+
+def _iterate_chunks(pots, chunk_size):
+    nt = pots.shape[1]
+    for start in range(0, nt, chunk_size):
+        stop = min(start + chunk_size, nt)
+        yield np.asarray(pots[:, start:stop], dtype=float)
+
+
+class KCSDBase(object):
+    """
+    Estimation, storage and model building routines shared by the 1D, 2D
+    and 3D solvers. The solvers define the estimation space and sources
+    through grid_positions(), source_positions(), grid_axes(),
+    source_axes() and grid_coordinates(), and compute the dist_table
+    and the basis matrices for their dimensionality.
+    """
+
+    def validate_pots(self, elec_pos, pots):
+        if pots is None:
+            raise Exception("No potentials to estimate from!")
+        if elec_pos.shape[0] != pots.shape[0]:
+            raise Exception("Number of measured potentials is not equal "
+                            "to electrode number!")
+
+    def estimate_pots(self):
+        """Calculates Local Field Potentials."""
+        self.estimated_pots = self.transform(self.sampled_pots, 'pots')
+        return self.estimated_pots
+
+    def estimate_csd(self):
+        """Calculates Current Source Density."""
+        self.estimated_csd = self.transform(self.sampled_pots, 'csd')
+        return self.estimated_csd
+
+    def transform(self, pots, target='csd'):
+        """
+        Estimates CSD or potentials from potentials recorded with
+        the same electrodes, reusing the already built model.
+
+        **Parameters**
+
+        pots : numpy array, numpy memmap or h5py dataset
+            potentials measured by electrodes (n_elec x nt)
+
+        target : str, optional
+            'csd' or 'pots'
+        """
+        self.validate_pots(self.elec_pos, pots)
+        operator = self.get_operator(target)
+        return self.estimate(operator, pots)
+
+    def iterate_transform(self, pots, target='csd', chunk_size=None):
+        """
+        Generator version of transform(), which estimates CSD or potentials
+        in time chunks, so the memory usage is bounded by the chunk size
+        and not by the length of the recording.
+
+        **Parameters**
+
+        pots : numpy array, numpy memmap or h5py dataset
+            potentials measured by electrodes (n_elec x nt)
+
+        target : str, optional
+            'csd' or 'pots'
+
+        chunk_size : int, optional
+            number of time samples in a chunk, defaults to 'chunk_size'
+            parameter of the solver
+        """
+        self.validate_pots(self.elec_pos, pots)
+        operator = self.get_operator(target)
+        if chunk_size is None:
+            chunk_size = self.chunk_size
+        chunks = iterate_chunks(pots, chunk_size)
+        return (self.estimate(operator, pots_chunk) for pots_chunk in chunks)
+
+    def iterate_pots(self, chunk_size=None):
+        """Calculates Local Field Potentials chunk by chunk."""
+        return self.iterate_transform(self.sampled_pots, 'pots', chunk_size)
+
+    def iterate_csd(self, chunk_size=None):
+        """Calculates Current Source Density chunk by chunk."""
+        return self.iterate_transform(self.sampled_pots, 'csd', chunk_size)
+
+    def estimate(self, operator, pots):
+        """
+        Applies the estimation operator to the potentials and reshapes
+        the result to the shape of the estimation space.
+        """
+        estimation = estimate(operator, pots, self.chunk_size)
+        return estimation.reshape(self.space_X.shape + estimation.shape[1:])
+
+    def factorize_k_pot(self):
+        """
+        Returns the eigendecomposition of k_pot, which is reused between
+        the estimations and recomputed only if k_pot has changed.
+        """
+        self._k_pot_factorization = factorize(self.k_pot,
+                                              self._k_pot_factorization)
+        return self._k_pot_factorization
+
+    def get_operator(self, target):
+        """
+        Returns the estimation operator for 'csd' or 'pots'.
+        """
+        operators = {
+            'csd': self.get_csd_operator,
+            'pots': self.get_pots_operator,
+        }
+        if target not in operators.keys():
+            raise Exception("Incorrect estimation target!")
+        return operators.get(target)()
+
+    def get_pots_operator(self):
+        """
+        Returns the linear operator (n_grid x n_elec) which maps
+        the measured potentials onto the estimated potentials.
+        """
+        factorization = self.factorize_k_pot()
+        return factorization.operator(self.lambd, self.interp_pot)
+
+    def get_csd_operator(self):
+        """
+        Returns the linear operator (n_grid x n_elec) which maps
+        the measured potentials onto the estimated CSD.
+        """
+        factorization = self.factorize_k_pot()
+        return factorization.operator(self.lambd, self.k_interp_cross)
+
+    def save(self, filename='result', chunk_size=None):
+        """
+        Save estimated CSD and potentials together with the estimation
+        space and parameters to a HDF5 file (.h5, .hdf5) or a directory
+        of .npy blocks. The results are estimated and written in time
+        chunks, so they are never held in memory as a whole.
+        """
+        self.validate_pots(self.elec_pos, self.sampled_pots)
+        operators = {
+            'estimated_csd': self.get_operator('csd'),
+            'estimated_pots': self.get_operator('pots'),
+        }
+        if chunk_size is None:
+            chunk_size = self.chunk_size
+        # every chunk is read once and used for both estimations
+        results = (dict((name, self.estimate(operator, pots_chunk))
+                        for (name, operator) in operators.items())
+                   for pots_chunk in iterate_chunks(self.sampled_pots,
+                                                    chunk_size))
+        params = su.scalar_parameters(vars(self))
+        su.save_results(filename, results, self.grid_coordinates(), params)
+
+    def load(self, filename):
+        """Load estimated CSD and potentials written by save()."""
+        data = su.load_results(filename)
+        self.estimated_csd = data['estimated_csd']
+        self.estimated_pots = data['estimated_pots']
+        return data
+
+    def save_model(self, dirname='model'):
+        """
+        Save the matrices built by init_model() to a directory,
+        so the model can be reused without rebuilding it.
+        """
+        arrays = dict((name, getattr(self, name)) for name in su.MODEL_ARRAYS)
+        arrays['elec_pos'] = self.elec_pos
+        params = su.scalar_parameters(vars(self))
+        su.save_model(dirname, arrays, params)
+
+    def load_model(self, dirname='model', mmap_mode='r'):
+        """
+        Load the matrices saved with save_model() instead of calling
+        init_model(). By default the matrices are memory mapped.
+        """
+        arrays, params = su.load_model(dirname, mmap_mode)
+        if not np.array_equal(arrays.pop('elec_pos'), self.elec_pos):
+            raise Exception("Model was built for different electrodes!")
+        su.check_model_parameters(params, su.scalar_parameters(vars(self)))
+        for (name, array) in arrays.items():
+            setattr(self, name, array)
+
+    def init_model(self):
+        """
+        Prepares all the required matrices to calculate CSD and potentials.
+        """
+        self.create_dist_table()
+
+        self.calculate_b_pot_matrix()
+        self.k_pot = dot(self.b_pot_matrix.T, self.b_pot_matrix)
+
+        lattice = None
+        if self.fft:
+            lattice = cu.find_lattice(self.grid_positions(),
+                                      self.source_positions())
+
+        if lattice is not None:
+            self.calculate_cross_matrices_fft(lattice)
+        elif self.low_memory:
+            self.calculate_cross_matrices()
+        else:
+            self.calculate_b_src_matrix()
+            self.k_interp_cross = self.b_src_matrix.dot(self.b_pot_matrix)
+
+            self.calculate_b_interp_pot_matrix()
+            self.interp_pot = dot(self.b_interp_pot_matrix, self.b_pot_matrix)
+
+    def calculate_cross_matrices(self):
+        """
+        Computes k_interp_cross and interp_pot block by block, so that
+        b_src_matrix and b_interp_pot_matrix never have to be stored.
+        """
+        self.b_src_matrix = None
+        self.b_interp_pot_matrix = None
+        grid_pos = self.grid_positions()
+        src_pos = self.source_positions()
+        if bf.is_separable(self.basis):
+            self.k_interp_cross = mu.calculate_separable_k_interp_cross(
+                self.basis,
+                self.grid_axes(),
+                self.source_axes(),
+                self.R,
+                self.b_pot_matrix
+            )
+        else:
+            self.k_interp_cross = mu.calculate_k_interp_cross(
+                self.basis,
+                grid_pos,
+                src_pos,
+                self.R,
+                self.b_pot_matrix,
+                self.mem_budget
+            )
+        self.interp_pot = mu.calculate_interp_pot(grid_pos,
+                                                  src_pos,
+                                                  self.dist_max,
+                                                  self.potential_lookup(),
+                                                  self.b_pot_matrix,
+                                                  self.mem_budget)
+
+    def calculate_cross_matrices_fft(self, lattice):
+        """
+        Computes k_interp_cross and interp_pot as convolutions of the sources
+        weighted by b_pot_matrix, for sources aligned with the estimation
+        grid.
+        """
+        self.b_src_matrix = None
+        self.b_interp_pot_matrix = None
+        self.k_interp_cross = cu.calculate_k_interp_cross(self.basis,
+                                                          lattice,
+                                                          self.R,
+                                                          self.b_pot_matrix)
+        self.interp_pot = cu.calculate_interp_pot(lattice,
+                                                  self.dist_max,
+                                                  self.potential_lookup(),
+                                                  self.b_pot_matrix)
+
+    def potential_lookup(self):
+        """
+        Returns the dist_table in the form used to evaluate potentials
+        of the sources, according to dist_lookup.
+        """
+        return dt.make_lookup(self.dist_table, self.dist_max,
+                              self.dist_lookup)
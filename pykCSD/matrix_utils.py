@@ -0,0 +1,446 @@
+# -*- coding: utf-8 -*-
+from __future__ import division
+
+import numpy as np
+from numpy import dot
+from scipy.sparse import csr_matrix
+from scipy.spatial import cKDTree
+from scipy.spatial.distance import cdist
+
+from . import dist_table_utils as dt
+
+"""
+This module contains routines shared by the 1D, 2D and 3D solvers
+for building the matrices of the kCSD model.
+"""
+
+# smallest number of grid points in a block of accumulate_product()
+MIN_BLOCK_ROWS = 64
+
+# relative margin of the support radius, so that the points lying exactly
+# on the boundary of a basis function are not lost to rounding
+SUPPORT_TOLERANCE = 1e-9
+
+
+def calculate_b_pot_matrix(src_pos, elec_pos, dist_max, dist_table):
+    """
+    Computes the matrix of potentials generated by every source basis
+    function at every electrode position.
+
+    **Parameters**
+
+    src_pos : np.array
+        positions of the sources (n_src x dim)
+
+    elec_pos : np.array
+        positions of the electrodes (n_elec x dim)
+
+    dist_max : float
+        distance between two most distant points in estimation space
+
+    dist_table : np.array
+        potential as a probed function of distance
+
+    **Returns**
+
+    b_pot_matrix : np.array
+        potentials of the sources at the electrodes (n_src x n_elec)
+    """
+    dists = cdist(src_pos, elec_pos)
+    b_pot_matrix = dt.generated_potential(dists, dist_max, dist_table)
+    return b_pot_matrix
+
+
+def calculate_b_src_matrix(basis, grid_pos, src_pos, R, mem_budget):
+    """
+    Computes the matrix of values of every source basis function
+    at every point of the estimation space, many sources at a time.
+
+    **Parameters**
+
+    basis : callable
+        basis function template
+
+    grid_pos : np.array
+        points of the estimation space (n_grid x dim)
+
+    src_pos : np.array
+        positions of the sources (n_src x dim)
+
+    R : float
+        basis function radius
+
+    mem_budget : int
+        memory (in bytes) available for a block of the matrix
+
+    **Returns**
+
+    b_src_matrix : np.array
+        basis functions at the estimation points (n_grid x n_src)
+    """
+    def block_func(cols):
+        return basis_block(basis, grid_pos, src_pos[cols], R)
+    return assemble_matrix(block_func, len(grid_pos), len(src_pos),
+                           mem_budget)
+
+
+def calculate_sparse_b_src_matrix(basis, grid_pos, src_pos, R):
+    """
+    Computes b_src_matrix as a sparse matrix for a basis function
+    which vanishes farther than R from its center. The basis is evaluated
+    only at the grid points found within the support of each source.
+
+    **Parameters**
+
+    basis : callable
+        compactly supported basis function template
+
+    grid_pos : np.array
+        points of the estimation space (n_grid x dim)
+
+    src_pos : np.array
+        positions of the sources (n_src x dim)
+
+    R : float
+        basis function radius
+
+    **Returns**
+
+    b_src_matrix : scipy.sparse.csr_matrix
+        basis functions at the estimation points (n_grid x n_src)
+    """
+    grid_tree = cKDTree(grid_pos)
+    src_tree = cKDTree(src_pos)
+    pairs = grid_tree.sparse_distance_matrix(src_tree,
+                                             R * (1 + SUPPORT_TOLERANCE),
+                                             output_type='ndarray')
+    rows = pairs['i']
+    cols = pairs['j']
+    values = evaluate_basis(basis, grid_pos[rows], src_pos[cols], R)
+    b_src_matrix = csr_matrix((values, (rows, cols)),
+                              shape=(len(grid_pos), len(src_pos)))
+    b_src_matrix.eliminate_zeros()
+    return b_src_matrix
+
+
+def calculate_separable_b_src_matrix(basis, grid_axes, src_axes, R):
+    """
+    Computes b_src_matrix for a separable basis function on tensor product
+    grids, as an outer product of small one-dimensional factor matrices.
+
+    **Parameters**
+
+    basis : callable
+        separable basis function template
+
+    grid_axes : list of tuples
+        (coordinate, values) for every axis of the estimation grid,
+        in the order in which the points are flattened (C order)
+
+    src_axes : list of tuples
+        (coordinate, values) for every axis of the source lattice,
+        in the order in which the sources are flattened (C order)
+
+    R : float
+        basis function radius
+
+    **Returns**
+
+    b_src_matrix : np.array
+        basis functions at the estimation points (n_grid x n_src)
+    """
+    (grid_idx, src_idx, factors_idx, factors) = _separable_factors(
+        basis, grid_axes, src_axes, R)
+    b_src_matrix = np.einsum(factors_idx + '->' + grid_idx + src_idx,
+                             *factors)
+    n_grid = np.prod([len(values) for (_, values) in grid_axes])
+    return b_src_matrix.reshape(n_grid, -1)
+
+
+def calculate_separable_k_interp_cross(basis, grid_axes, src_axes, R,
+                                       b_pot_matrix):
+    """
+    Computes k_interp_cross = b_src_matrix * b_pot_matrix for a separable
+    basis function by contracting b_pot_matrix with the factor matrices
+    axis by axis, without forming b_src_matrix.
+
+    **Parameters**
+
+    basis : callable
+        separable basis function template
+
+    grid_axes, src_axes : lists of tuples
+        axes of the estimation grid and the source lattice,
+        see calculate_separable_b_src_matrix()
+
+    R : float
+        basis function radius
+
+    b_pot_matrix : np.array
+        potentials of the sources at the electrodes (n_src x n_elec)
+
+    **Returns**
+
+    k_interp_cross : np.array
+        cross kernel of the estimation space and electrodes (n_grid x n_elec)
+    """
+    (grid_idx, src_idx, factors_idx, factors) = _separable_factors(
+        basis, grid_axes, src_axes, R)
+    src_shape = tuple(len(values) for (_, values) in src_axes)
+    weights = b_pot_matrix.reshape(src_shape + (-1,))
+    k_interp_cross = np.einsum(
+        factors_idx + ',' + src_idx + 'z->' + grid_idx + 'z',
+        *(factors + [weights]),
+        optimize=True
+    )
+    return k_interp_cross.reshape(-1, b_pot_matrix.shape[1])
+
+
+def _separable_factors(basis, grid_axes, src_axes, R):
+    """
+    Returns the factor matrices of the basis for every coordinate,
+    with einsum subscripts of the grid axes, the source axes
+    and the factors.
+
+    The factor of a coordinate is the basis evaluated along that coordinate
+    only, so every factor contains the value at the center once. All but
+    one factor are divided by it.
+    """
+    dim = len(grid_axes)
+    grid_idx = 'abc'[:dim]
+    src_idx = 'def'[:dim]
+    src_coords = [coord for (coord, _) in src_axes]
+    center = np.zeros(dim)
+    center_value = evaluate_basis(basis, center, center, R)
+    factors_idx = []
+    factors = []
+    for (i, (coord, grid_values)) in enumerate(grid_axes):
+        j = src_coords.index(coord)
+        src_values = src_axes[j][1]
+        offsets = np.zeros((len(grid_values), len(src_values), dim))
+        offsets[:, :, coord] = grid_values[:, None] - src_values[None, :]
+        factor = evaluate_basis(basis, offsets, center, R)
+        if i > 0:
+            factor = factor / center_value
+        factors_idx.append(grid_idx[i] + src_idx[j])
+        factors.append(factor)
+    return (grid_idx, src_idx, ','.join(factors_idx), factors)
+
+
+def calculate_b_interp_pot_matrix(grid_pos, src_pos, dist_max, dist_table,
+                                  mem_budget):
+    """
+    Computes the matrix of potentials generated by every source basis
+    function at every point of the estimation space, many sources at a time.
+
+    **Parameters**
+
+    grid_pos : np.array
+        points of the estimation space (n_grid x dim)
+
+    src_pos : np.array
+        positions of the sources (n_src x dim)
+
+    dist_max : float
+        distance between two most distant points in estimation space
+
+    dist_table : np.array
+        potential as a probed function of distance
+
+    mem_budget : int
+        memory (in bytes) available for a block of the matrix
+
+    **Returns**
+
+    b_interp_pot_matrix : np.array
+        potentials of the sources at the estimation points (n_grid x n_src)
+    """
+    def block_func(cols):
+        return potential_block(grid_pos, src_pos[cols], dist_max, dist_table)
+    return assemble_matrix(block_func, len(grid_pos), len(src_pos),
+                           mem_budget)
+
+
+def calculate_k_interp_cross(basis, grid_pos, src_pos, R, b_pot_matrix,
+                             mem_budget):
+    """
+    Computes k_interp_cross = b_src_matrix * b_pot_matrix block by block,
+    without storing the whole b_src_matrix.
+
+    **Parameters**
+
+    basis : callable
+        basis function template
+
+    grid_pos : np.array
+        points of the estimation space (n_grid x dim)
+
+    src_pos : np.array
+        positions of the sources (n_src x dim)
+
+    R : float
+        basis function radius
+
+    b_pot_matrix : np.array
+        potentials of the sources at the electrodes (n_src x n_elec)
+
+    mem_budget : int
+        memory (in bytes) available for a block of b_src_matrix
+
+    **Returns**
+
+    k_interp_cross : np.array
+        cross kernel of the estimation space and electrodes (n_grid x n_elec)
+    """
+    def block_func(rows, cols):
+        return basis_block(basis, grid_pos[rows], src_pos[cols], R)
+    return accumulate_product(block_func, b_pot_matrix, len(grid_pos),
+                              mem_budget)
+
+
+def calculate_interp_pot(grid_pos, src_pos, dist_max, dist_table,
+                         b_pot_matrix, mem_budget):
+    """
+    Computes interp_pot = b_interp_pot_matrix * b_pot_matrix block by block,
+    without storing the whole b_interp_pot_matrix.
+
+    **Parameters**
+
+    grid_pos : np.array
+        points of the estimation space (n_grid x dim)
+
+    src_pos : np.array
+        positions of the sources (n_src x dim)
+
+    dist_max : float
+        distance between two most distant points in estimation space
+
+    dist_table : np.array
+        potential as a probed function of distance
+
+    b_pot_matrix : np.array
+        potentials of the sources at the electrodes (n_src x n_elec)
+
+    mem_budget : int
+        memory (in bytes) available for a block of b_interp_pot_matrix
+
+    **Returns**
+
+    interp_pot : np.array
+        potential kernel of the estimation space and electrodes
+        (n_grid x n_elec)
+    """
+    def block_func(rows, cols):
+        return potential_block(grid_pos[rows], src_pos[cols], dist_max,
+                               dist_table)
+    return accumulate_product(block_func, b_pot_matrix, len(grid_pos),
+                              mem_budget)
+
+
+def basis_block(basis, grid_pos, src_pos, R):
+    """
+    Evaluates basis functions centered at src_pos in all the grid points.
+
+    **Returns**
+
+    block : np.array
+        values of the basis functions (n_grid x n_src)
+    """
+    block = evaluate_basis(basis, grid_pos[:, None, :], src_pos[None, :, :],
+                           R)
+    return np.broadcast_to(block, (len(grid_pos), len(src_pos)))
+
+
+def evaluate_basis(basis, points, centers, R):
+    """
+    Evaluates basis functions centered at centers in points. The last axis
+    of both arrays holds the coordinates, the other axes are broadcast.
+    """
+    dim = points.shape[-1]
+    coords = [points[..., d] for d in range(dim)]
+    mu = [centers[..., d] for d in range(dim)]
+    if dim == 1:
+        mu = mu[0]
+    return basis(*(coords + [mu, R]))
+
+
+def potential_block(grid_pos, src_pos, dist_max, dist_table):
+    """
+    Evaluates potentials of sources at src_pos in all the grid points.
+
+    **Returns**
+
+    block : np.array
+        potentials of the sources (n_grid x n_src)
+    """
+    dists = cdist(grid_pos, src_pos)
+    return dt.generated_potential(dists, dist_max, dist_table)
+
+
+def assemble_matrix(block_func, n_rows, n_cols, mem_budget):
+    """
+    Builds a matrix from column blocks, each block fitting in mem_budget.
+
+    **Parameters**
+
+    block_func : callable
+        returns the columns of the matrix selected by a slice
+
+    n_rows, n_cols : ints
+        shape of the matrix
+
+    mem_budget : int
+        memory (in bytes) available for a block of the matrix
+    """
+    matrix = np.empty((n_rows, n_cols))
+    for cols in iterate_blocks(n_cols, block_size(n_rows, mem_budget)):
+        matrix[:, cols] = block_func(cols)
+    return matrix
+
+
+def accumulate_product(block_func, weights, n_rows, mem_budget):
+    """
+    Computes the product of a matrix, given by its blocks, and weights.
+    Only one block of the matrix is held in memory at a time.
+
+    **Parameters**
+
+    block_func : callable
+        returns the block of the matrix selected by a pair of slices
+        (rows, columns)
+
+    weights : np.array
+        right hand side of the product (n_cols x k)
+
+    n_rows : int
+        number of rows of the matrix
+
+    mem_budget : int
+        memory (in bytes) available for a block of the matrix
+    """
+    n_cols = weights.shape[0]
+    # prefer whole rows of sources, as long as a reasonable number of grid
+    # points still fits in the budget
+    col_size = min(n_cols, block_size(MIN_BLOCK_ROWS, mem_budget))
+    row_size = block_size(col_size, mem_budget)
+    product = np.zeros((n_rows, weights.shape[1]))
+    for rows in iterate_blocks(n_rows, row_size):
+        for cols in iterate_blocks(n_cols, col_size):
+            product[rows] += dot(block_func(rows, cols), weights[cols])
+    return product
+
+
+def block_size(n_rows, mem_budget):
+    """
+    Returns the number of float64 columns of height n_rows which fit
+    in mem_budget bytes (at least one).
+    """
+    return max(1, int(mem_budget // (8 * max(n_rows, 1))))
+
+
+def iterate_blocks(n, size):
+    """
+    Yields slices splitting range(n) into consecutive blocks.
+    """
+    for start in range(0, n, size):
+        yield slice(start, min(start + size, n))
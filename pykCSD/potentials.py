@@ -1,9 +1,14 @@
 # -*- coding: utf-8 -*-
 from __future__ import division
 
+from collections import OrderedDict
+from functools import partial
+
 import numpy as np
 
 from scipy import integrate
+from scipy.special import erf
+from scipy.interpolate import CubicSpline
 from numpy import pi
 from skmonaco import mcmiser
 
@@ -14,26 +19,65 @@ This module contains routines for calculating potentials in 1D, 2D, 3D case.
 This consists of both integrands and integrals.
 """
 
+# radius (in units of R) beyond which bases without compact support
+# are neglected in radial integration, 3R is 9 standard deviations
+# of the gauss basis
+RADIAL_CUTOFF = 3.0
+
+# number of Gauss-Legendre nodes in every radial integral
+RADIAL_QUADRATURE_ORDER = 64
+
+# number of Gauss-Legendre nodes per direction in every part
+# of the 2D slice potential integral
+QUADRATURE_ORDER_2D = 32
+
+# number of distances integrated at once by b_pot_2d_quad, which bounds
+# the size of its (distances x nodes x nodes) temporaries
+QUADRATURE_BLOCK_2D = 256
+
+# spacing (in units of R) of the master table nodes up to MASTER_DENSE_RANGE,
+# farther the spacing grows geometrically by MASTER_GROWTH
+MASTER_STEP = 1/128
+MASTER_DENSE_RANGE = 4.0
+MASTER_GROWTH = 1.01
+
+# number of master tables kept, the least recently used ones are dropped
+MASTER_TABLES_SIZE = 32
+
+# master tables of the potentials of the basis functions with R = 1
+# and sigma = 1, splines of the distance keyed by (pot_func, basis, h/R),
+# with h/R replaced by None for H_INDEPENDENT_POTENTIALS
+_master_tables = OrderedDict()
+
 
 def b_pot_1d_cont(src, arg, R, h, sigma, basis_func):
     """
-    Returns potential as a function of distance from the source.
+    Returns potential as a function of distance from the source,
+    arg may be an array of positions.
     """
     resolution = 51
     x = np.array(np.linspace(src - 4*R, src + 4*R, resolution))
-    potx = np.array([int_pot_1D(src, arg, current_pos, h, R, sigma, basis_func)
-                    for current_pos in x]).flatten()
+    arg = np.asarray(arg, dtype=float)[..., None]
+    potx = int_pot_1D(src, arg, x, h, R, sigma, basis_func)
 
-    pot = np.trapz(potx, x)
+    pot = np.trapz(potx, x, axis=-1)
 
     return pot
 
 
+def b_pot_1d(x, R, h, sigma, basis_func):
+    """
+    Returns potential at distance(s) x from a source located at 0,
+    with the signature used by dist_table_utils.create_dist_table.
+    """
+    return b_pot_1d_cont(0, x, R, h, sigma, basis_func)
+
+
 def int_pot_1D(src, arg, curr_pos, h, R, sigma, basis_func):
     """
     Returns contribution of a single source as a function of distance
     """
-    pot = (((arg - curr_pos)**2 + h**2)**0.5 - abs(arg - curr_pos))
+    pot = (((arg - curr_pos)**2 + h**2)**0.5 - np.abs(arg - curr_pos))
     pot *= 1./(2 * sigma)
 
     # for this formula look at formula (8) from Pettersen et al., 2006
@@ -55,6 +99,64 @@ def b_pot_2d_cont(x, R, h, sigma, src_type):
     return pot
 
 
+def b_pot_2d_quad(x, R, h, sigma, basis_func):
+    """
+    Returns the value of the potential at points (x,0) generated
+    by a basis source located at (0,0), for all x at once.
+
+    The integral of int_pot_2D is computed with fixed-order Gauss-Legendre
+    quadrature, in polar coordinates over the disk of radius R for
+    compactly supported bases and over the square [-R, R]^2 (as in
+    b_pot_2d_cont) otherwise. The integration domain is split at the
+    logarithmic singularity of the integrand at (x,0). The distances
+    are integrated in blocks of QUADRATURE_BLOCK_2D, so the memory usage
+    does not grow with the number of distances.
+    """
+    x = np.abs(np.asarray(x, dtype=float))
+    if bf.has_compact_support(basis_func):
+        int_pot = _int_pot_2D_polar
+    else:
+        int_pot = _int_pot_2D_square
+    xs = x.ravel()
+    pot = np.empty(xs.shape)
+    for start in range(0, len(xs), QUADRATURE_BLOCK_2D):
+        stop = start + QUADRATURE_BLOCK_2D
+        pot[start:stop] = int_pot(xs[start:stop], R, h, basis_func)
+    pot *= 1./(2.0*pi*sigma)
+    return pot.reshape(x.shape)
+
+
+def _int_pot_2D_square(x, R, h, basis_func):
+    split = np.minimum(x, R)
+    (xp_l, wx_l) = _gauss_legendre_nodes(-R, split, QUADRATURE_ORDER_2D)
+    (xp_r, wx_r) = _gauss_legendre_nodes(split, R, QUADRATURE_ORDER_2D)
+    xp = np.concatenate((xp_l, xp_r), axis=-1)
+    wx = np.concatenate((wx_l, wx_r), axis=-1)
+    (yp_l, wy_l) = _gauss_legendre_nodes(-R, 0.0, QUADRATURE_ORDER_2D)
+    (yp_r, wy_r) = _gauss_legendre_nodes(0.0, R, QUADRATURE_ORDER_2D)
+    yp = np.concatenate((yp_l, yp_r))
+    wy = np.concatenate((wy_l, wy_r))
+
+    values = int_pot_2D(xp[..., None], yp, x[..., None, None], R, h,
+                        basis_func)
+    return np.einsum('...ij,...i,j->...', values, wx, wy)
+
+
+def _int_pot_2D_polar(x, R, h, basis_func):
+    split = np.minimum(x, R)
+    (r_in, wr_in) = _gauss_legendre_nodes(0.0, split, QUADRATURE_ORDER_2D)
+    (r_out, wr_out) = _gauss_legendre_nodes(split, R, QUADRATURE_ORDER_2D)
+    r = np.concatenate((r_in, r_out), axis=-1)
+    wr = np.concatenate((wr_in, wr_out), axis=-1)
+    # the integrand is symmetric in yp, so only the upper half is integrated
+    (theta, wt) = _gauss_legendre_nodes(0.0, pi, 2*QUADRATURE_ORDER_2D)
+
+    r = r[..., None]
+    values = int_pot_2D(r*np.cos(theta), r*np.sin(theta),
+                        x[..., None, None], R, h, basis_func) * r
+    return 2*np.einsum('...ij,...i,j->...', values, wr, wt)
+
+
 def int_pot_2D(xp, yp, x, R, h, basis_func):
     """
     Returns contribution of a point xp,yp, belonging to a basis source
@@ -64,11 +166,11 @@ def int_pot_2D(xp, yp, x, R, h, basis_func):
 
     **Parameters**
 
-    xp, yp : floats
+    xp, yp : floats or np.arrays
         coordinates of some point laying in the support of a
         basis element centered at (0,0)
     
-    x : float
+    x : float or np.array
         coordinates of a point (x,0) at which we calculate the potential
     
     R : float
@@ -82,8 +184,7 @@ def int_pot_2D(xp, yp, x, R, h, basis_func):
     pot : float
     """
     y = ((x-xp)**2 + yp**2)**(0.5)
-    if y < 0.00001:
-        y = 0.00001
+    y = np.maximum(y, 0.00001)
     pot = np.arcsinh(h/y)
 
     pot *= basis_func(xp, yp, [0, 0], R)
@@ -137,14 +238,17 @@ def int_pot_3D(xp, yp, zp, x, R, h, basis_func):
     return y
 
 
-def b_pot_3d_mc(x, R, h, sigma, basis_func=bf.gauss_rescale_3D):
+def b_pot_3d_mc(x, R, h, sigma, basis_func=bf.gauss_rescale_3D, nprocs=4):
     """
     Calculate potential in the 3D case using Monte Carlo integration.
-    It utilizes the MISER algorithm
+    It utilizes the MISER algorithm, running on nprocs processes.
+    When the distances are already spread over a pool of workers
+    (create_dist_table with n_jobs > 1) use nprocs=1, e.g. through
+    functools.partial(b_pot_3d_mc, nprocs=1).
     """
     pot, err = mcmiser(int_pot_3D_mc, npoints=1e5,
                        xl=[-R, -R, -R], xu=[R, R, R],
-                       nprocs=4, args=(x, R, h, basis_func))
+                       nprocs=nprocs, args=(x, R, h, basis_func))
     pot *= 1./(4.0*pi*sigma)
     return pot
 
@@ -157,27 +261,216 @@ def int_pot_3D_mc(xyz, x, R, h, basis_func):
     return int_pot_3D(xp, yp, zp, x, R, h, basis_func)
 
 
-def b_pot_3d_analytic(x, R, h, sigma, basis):
+def b_pot_3d_radial(x, R, h, sigma, basis_func):
+    """
+    Calculate 3D potential of a spherically symmetric source by reducing
+    the volume integral to one-dimensional radial integrals:
+
+    V(r) = 1/sigma * (1/r * int_0^r s^2 rho(s) ds + int_r^inf s rho(s) ds)
+
+    where rho(s) is the basis function at distance s from its center.
+    Both integrals are computed with fixed-order Gauss-Legendre quadrature
+    for all the distances at once.
+
+    **Parameters**
+    
+    x : float or np.array
+        distance(s) from the center of the source
+
+    R : float
+        radius of the basis element
+
+    h : float
+        not used in 3D
+
+    sigma : float
+        volumetric conductivity (scalar)
+
+    basis_func : callable
+        spherically symmetric 3D basis function
+
+    **Returns**
+
+    pot : float or np.array
+    """
+    if bf.has_compact_support(basis_func):
+        s_max = R
+    else:
+        s_max = RADIAL_CUTOFF * R
+    r = np.abs(np.asarray(x, dtype=float))
+    split = np.minimum(r, s_max)
+
+    def profile(s):
+        return basis_func(s, 0.0, 0.0, [0.0, 0.0, 0.0], R)
+
+    inner = _gauss_legendre(lambda s: s**2 * profile(s), 0.0, split)
+    outer = _gauss_legendre(lambda s: s * profile(s), split, s_max)
+    r_safe = np.where(r > 0, r, 1.0)
+    pot = np.where(r > 0, inner/r_safe, 0.0) + outer
+    return pot/sigma
+
+
+def _gauss_legendre(func, a, b, order=None):
+    """
+    Integrates func over [a, b] with Gauss-Legendre quadrature,
+    a and b may be arrays of interval ends.
+    """
+    if order is None:
+        order = RADIAL_QUADRATURE_ORDER
+    (points, weights) = _gauss_legendre_nodes(a, b, order)
+    return np.sum(func(points) * weights, axis=-1)
+
+
+def _gauss_legendre_nodes(a, b, order):
     """
-    Calculate 3D potential using analytic scheme assuming step
-    spherical-symmetric source.
+    Returns Gauss-Legendre nodes and weights for the interval [a, b],
+    with the nodes in the last axis if a or b are arrays.
+    """
+    (nodes, weights) = np.polynomial.legendre.leggauss(order)
+    a = np.asarray(a, dtype=float)[..., None]
+    b = np.asarray(b, dtype=float)[..., None]
+    half = (b - a)/2
+    return (a + half*(nodes + 1), half*weights)
+
+
+def b_pot_3d_analytic(x, R, h, sigma, basis_func):
+    """
+    Calculate 3D potential of a spherically symmetric source using
+    a closed-form expression, for all the distances at once.
     This aims to reduce execution time for 3d reconstructions.
 
     **Parameters**
     
-    x : float
-        space point where we calculate potential
+    x : float or np.array
+        distance(s) from the center of the source
 
     R : float
-        radius of sphere that contains sources
+        radius of the basis element
+
+    h : float
+        not used in 3D
 
     sigma : float
         volumetric conductivity (scalar)
+
+    basis_func : callable
+        basis function with a closed-form potential
+        (step_rescale_3D or gauss_rescale_3D)
+
+    **Returns**
+
+    pot : float or np.array
     """
-    pot = 0
-    C = 0.01
-    if x > R:
-        pot = C/(4*pi*sigma*x)
+    if basis_func not in ANALYTIC_POTENTIALS_3D:
+        raise Exception("No analytic potential for this basis function!")
+    return ANALYTIC_POTENTIALS_3D[basis_func](x, R, sigma)
+
+
+def pot_step_3D(x, R, sigma):
+    """
+    Returns potential of a uniformly charged ball with unit total charge.
+    Outside of the ball it is the potential of a point charge.
+    """
+    x = np.abs(x)
+    outside = 1./(4*pi*sigma*np.maximum(x, R))
+    inside = (3*R**2 - x**2)/(8*pi*sigma*R**3)
+    return np.where(x > R, outside, inside)
+
+
+def pot_gauss_3D(x, R, sigma):
+    """
+    Returns potential of a normalized gaussian charge distribution
+    with standard deviation R/3.
+    """
+    stdev = R/3.0
+    x = np.abs(x)
+    # erf(x/a)/x tends to 2/(sqrt(pi)*a) at 0
+    x_safe = np.where(x > 0, x, 1.0)
+    pot = np.where(x > 0,
+                   erf(x_safe/(np.sqrt(2)*stdev))/x_safe,
+                   np.sqrt(2/pi)/stdev)
+    return pot/(4*pi*sigma)
+
+
+ANALYTIC_POTENTIALS_3D = {
+    bf.step_rescale_3D: pot_step_3D,
+    bf.gauss_rescale_3D: pot_gauss_3D,
+}
+
+# potentials of 3D sources, which do not depend on h, so their master
+# tables are shared by all h/R ratios
+H_INDEPENDENT_POTENTIALS = (
+    b_pot_3d_cont,
+    b_pot_3d_mc,
+    b_pot_3d_radial,
+    b_pot_3d_analytic,
+)
+
+
+def b_pot_scaled(pot_func, x, R, h, sigma, basis_func):
+    """
+    Returns potential at distance(s) x from the source, obtained
+    by rescaling the master table of pot_func.
+
+    The potential of the basis of radius R is the potential of the basis
+    of radius 1 (with the same h/R ratio) at x/R, multiplied by
+    R**2 * basis_R(0)/basis_1(0) / sigma. pot_func is evaluated only
+    to build the master table, once per basis and h/R, or once per basis
+    for H_INDEPENDENT_POTENTIALS. It has to accept an array of distances,
+    e.g. b_pot_1d, b_pot_2d_quad, b_pot_3d_radial.
+    Use functools.partial(b_pot_scaled, pot_func) as the pot_func of
+    dist_table_utils.create_dist_table.
+    """
+    r = np.abs(np.asarray(x, dtype=float))/R
+    master = master_table(pot_func, basis_func, h/R, np.max(r))
+    scale = R**2/sigma * (bf.center_value(basis_func, R) /
+                          bf.center_value(basis_func, 1.0))
+    return scale * master(r)
+
+
+def master_table(pot_func, basis_func, h_ratio, r_max):
+    """
+    Returns the potential of the basis of radius 1 and height h_ratio
+    in the medium of unit conductivity, as a spline of the distance
+    covering at least [0, r_max]. The spline is computed once and
+    extended only when a larger distance is requested.
+    """
+    # the ratio is rounded, so that the same geometry given with
+    # different R and h reuses the same table
+    h_ratio = float('%.12g' % h_ratio)
+    if depends_on_h(pot_func):
+        key = (pot_func, basis_func, h_ratio)
     else:
-        pot = 3*C/(8*pi*sigma*R**3) * (R**2 - x**2 / 2)
-    return pot
+        key = (pot_func, basis_func, None)
+    master = _master_tables.pop(key, None)
+    if master is None or master.x[-1] < r_max:
+        nodes = master_nodes(1.5 * r_max)
+        pots = pot_func(nodes, 1.0, h_ratio, 1.0, basis_func)
+        master = CubicSpline(nodes, pots)
+    _master_tables[key] = master
+    while len(_master_tables) > MASTER_TABLES_SIZE:
+        _master_tables.popitem(last=False)
+    return master
+
+
+def depends_on_h(pot_func):
+    """
+    Checks if the potential depends on h, that is if pot_func
+    (or the function it is a functools.partial of) is not one
+    of H_INDEPENDENT_POTENTIALS.
+    """
+    while isinstance(pot_func, partial):
+        pot_func = pot_func.func
+    return pot_func not in H_INDEPENDENT_POTENTIALS
+
+
+def master_nodes(r_max):
+    """
+    Returns the distances (in units of R) at which the master table
+    is evaluated, dense near the source and sparser far from it.
+    """
+    nodes = np.arange(0, MASTER_DENSE_RANGE, MASTER_STEP)
+    n_far = np.ceil(np.log(max(r_max, MASTER_DENSE_RANGE) /
+                           MASTER_DENSE_RANGE) / np.log(MASTER_GROWTH))
+    far = MASTER_DENSE_RANGE * MASTER_GROWTH**np.arange(n_far + 1)
+    return np.concatenate((nodes, far))
@@ -9,15 +9,17 @@ class KCSD(object):
     Main class for instantiating a Kernel Current Source Density Solver.
     """
 
-    def __init__(self, elec_pos, sampled_pots, params={}):
+    def __init__(self, elec_pos, sampled_pots=None, params={}, model_dir=None):
         """
         **Parameters**
 
         elec_pos : numpy array
             positions of electrodes
         
-        sampled_pots : numpy array
-            potentials measured by electrodes
+        sampled_pots : numpy array, numpy memmap or h5py dataset, optional
+            potentials measured by electrodes, may be omitted if the model
+            is only applied to new recordings with transform(); on-disk
+            arrays are read in time chunks during the estimation
         
         params : set, optional
             configuration parameters, that may contain the following keys:
@@ -51,6 +53,58 @@ class KCSD(object):
             'lambd' : float
                 regularization parameter for ridge regression
 
+            'chunk_size' : int
+                number of time samples estimated at once by the iterators
+                and read at once from on-disk potentials
+
+            'mem_budget' : int
+                memory (in bytes) for temporary blocks used to build the model
+
+            'low_memory' : bool
+                if True, k_interp_cross and interp_pot are accumulated block by
+                block and b_src_matrix and b_interp_pot_matrix are never stored
+
+            'sparse_basis' : bool
+                if True, b_src_matrix of a compactly supported basis ('step',
+                'gauss_lim') is built as a scipy.sparse matrix
+
+            'fft' : bool
+                if True and the sources lie on a lattice aligned with the
+                estimation grid, k_interp_cross and interp_pot are computed
+                as FFT convolutions
+
+            'n_jobs' : int
+                number of workers computing the dist_table
+
+            'executor' : str
+                type of the dist_table workers ('thread' or 'process')
+
+            'dist_table_cache' : str
+                directory of the on-disk cache of distance tables, which
+                are reused by models with the same basis and potential
+
+            'dist_table_cache_size' : int
+                limit (in bytes) of the dist_table cache size
+
+            'dist_table_step' : float
+                if given, the dist_table is sampled with this step up to the first
+                multiple of it beyond the estimation space diagonal, instead of
+                with the given density; models with a smaller estimation space
+                then reuse the cached tables of larger ones by truncation
+
+            'scaled_potentials' : bool
+                if True, the numerically integrated dist_table is rescaled
+                from a master table computed once per basis and h/R ratio
+
+            'dist_lookup' : str
+                evaluation of the potentials from the dist_table, 'nearest'
+                sample or 'spline' interpolation between the samples (which
+                needs a lower dist_table resolution for the same accuracy)
+
+        model_dir : str, optional
+            directory with a model saved with save_model(), which is loaded
+            instead of building the model from scratch
+
         **Methods**
 
         estimate_pots()
@@ -58,7 +112,23 @@ class KCSD(object):
         
         estimate_csd()
             Calculate Current Source Density using kCSD method.
+
+        transform(pots, target)
+            Calculate CSD or potentials for new recordings made with
+            the same electrodes, without rebuilding the model.
+
+        iterate_transform(pots, target, chunk_size)
+            Same as transform(), but yields the results in time chunks.
         
+        save(filename, chunk_size)
+            Save the results to file chunk by chunk.
+
+        load(filename)
+            Load the results saved with save().
+
+        save_model(dirname)
+            Save the model matrices, so they can be reused later.
+
         plot_all()
             Show a quick plot to investigate the data.
         """
@@ -73,7 +143,10 @@ class KCSD(object):
             self.solver = KCSD3D(elec_pos, sampled_pots, params)
         else:
             raise Exception("Incorrect electrode format.")
-        self.solver.init_model()
+        if model_dir is None:
+            self.solver.init_model()
+        else:
+            self.solver.load_model(model_dir)
 
     def estimate_pots(self):
         """
@@ -87,13 +160,38 @@ class KCSD(object):
         """
         self.solver.estimate_csd()
 
-    def save(self, filename='result'):
+    def transform(self, pots, target='csd'):
+        """
+        Calculates Current Source Density ('csd') or Local Field Potentials
+        ('pots') for new potentials measured with the same electrodes.
+        """
+        return self.solver.transform(pots, target)
+
+    def iterate_transform(self, pots, target='csd', chunk_size=None):
+        """
+        Calculates Current Source Density ('csd') or Local Field Potentials
+        ('pots') for new potentials, yielding the results in time chunks.
+        """
+        return self.solver.iterate_transform(pots, target, chunk_size)
+
+    def save(self, filename='result', chunk_size=None):
+        """
+        Save results to a HDF5 file (.h5, .hdf5) or a directory
+        of .npy blocks, writing them in time chunks.
+        """
+        self.solver.save(filename, chunk_size)
+
+    def load(self, filename):
+        """
+        Load results saved with save().
+        """
+        return self.solver.load(filename)
+
+    def save_model(self, dirname='model'):
         """
-        Save results to file.
+        Save the model matrices to a directory.
         """
-        #HDF5?
-        #.mat?
-        pass
+        self.solver.save_model(dirname)
 
     def plot_all(self):
         """
@@ -0,0 +1,250 @@
+# -*- coding: utf-8 -*-
+from __future__ import division
+
+import os
+import json
+import shutil
+
+import numpy as np
+
+try:
+    import h5py
+except ImportError:
+    h5py = None
+
+"""
+This module contains routines for saving and loading kCSD results
+and models.
+
+Results are written incrementally in time chunks either to a compressed
+HDF5 file (when the file name ends with .h5 or .hdf5, requires h5py)
+or to a directory of .npy blocks. Models are stored as a directory of
+.npy files, which can be memory mapped when loaded.
+"""
+
+HDF5_EXTENSIONS = ('.h5', '.hdf5')
+
+# matrices built by init_model(), which are needed for the estimation
+MODEL_ARRAYS = ('dist_table', 'b_pot_matrix', 'k_pot',
+                'k_interp_cross', 'interp_pot')
+
+# parameters which do not influence the model matrices
+RUNTIME_PARAMETERS = ('lambd', 'chunk_size', 'mem_budget', 'low_memory',
+                      'sparse_basis', 'fft', 'n_jobs', 'executor',
+                      'dist_table_cache', 'dist_table_cache_size')
+
+
+def is_hdf5_file(filename):
+    return os.path.splitext(filename)[1].lower() in HDF5_EXTENSIONS
+
+
+def scalar_parameters(attributes):
+    """
+    Selects the parameters which can be stored as file metadata
+    (numbers, strings and booleans) from the solver attributes.
+    """
+    params = {}
+    for (key, value) in attributes.items():
+        if key.startswith('_'):
+            continue
+        if isinstance(value, (bool, str, int, float, np.integer,
+                              np.floating)):
+            params[key] = value.item() if hasattr(value, 'item') else value
+    return params
+
+
+def save_results(filename, results, grid, params):
+    """
+    Writes the results chunk by chunk, so they never have to be
+    held in memory as a whole.
+
+    **Parameters**
+
+    filename : str
+        HDF5 file (.h5, .hdf5) or directory for .npy blocks
+
+    results : iterator
+        consecutive time chunks of the results, every chunk is a dict
+        mapping the names of the results to arrays whose last axis is time
+
+    grid : dict
+        coordinates of the estimation space
+
+    params : dict
+        scalar parameters of the solver
+    """
+    if is_hdf5_file(filename):
+        _save_results_hdf5(filename, results, grid, params)
+    else:
+        _save_results_npy(filename, results, grid, params)
+
+
+def load_results(filename):
+    """
+    Reads results written by save_results().
+
+    **Returns**
+
+    data : dict
+        results and grid coordinates as numpy arrays,
+        parameters as a dict under the 'params' key
+    """
+    if is_hdf5_file(filename):
+        return _load_results_hdf5(filename)
+    return _load_results_npy(filename)
+
+
+def _save_results_hdf5(filename, results, grid, params):
+    if h5py is None:
+        raise Exception("h5py is required to save results to HDF5!")
+    with h5py.File(filename, 'w') as f:
+        for (name, coords) in grid.items():
+            f.create_dataset('grid/' + name, data=coords)
+        for (key, value) in params.items():
+            f.attrs[key] = value
+
+        for chunks in results:
+            for (name, chunk) in chunks.items():
+                if name not in f:
+                    f.create_dataset(name,
+                                     shape=chunk.shape[:-1] + (0,),
+                                     maxshape=chunk.shape[:-1] + (None,),
+                                     dtype=chunk.dtype,
+                                     chunks=True,
+                                     compression='gzip')
+                dset = f[name]
+                nt = dset.shape[-1]
+                dset.resize(nt + chunk.shape[-1], axis=dset.ndim - 1)
+                dset[..., nt:] = chunk
+
+
+def _load_results_hdf5(filename):
+    if h5py is None:
+        raise Exception("h5py is required to load results from HDF5!")
+    data = {}
+    with h5py.File(filename, 'r') as f:
+        for (name, item) in f.items():
+            if name == 'grid':
+                for (coord_name, coords) in item.items():
+                    data[coord_name] = coords[...]
+            else:
+                data[name] = item[...]
+        data['params'] = dict((key, _from_hdf5_attr(value))
+                              for (key, value) in f.attrs.items())
+    return data
+
+
+def _from_hdf5_attr(value):
+    if isinstance(value, bytes):
+        return value.decode('utf-8')
+    if hasattr(value, 'item'):
+        return value.item()
+    return value
+
+
+def _save_results_npy(dirname, results, grid, params):
+    grid_dir = os.path.join(dirname, 'grid')
+    if not os.path.isdir(grid_dir):
+        os.makedirs(grid_dir)
+    for (name, coords) in grid.items():
+        np.save(os.path.join(grid_dir, name + '.npy'), coords)
+    with open(os.path.join(dirname, 'params.json'), 'w') as f:
+        json.dump(params, f, indent=4, sort_keys=True)
+
+    for (i, chunks) in enumerate(results):
+        for (name, chunk) in chunks.items():
+            result_dir = os.path.join(dirname, name)
+            if i == 0:
+                # blocks left from a previous, possibly longer, recording
+                if os.path.isdir(result_dir):
+                    shutil.rmtree(result_dir)
+                os.makedirs(result_dir)
+            np.save(os.path.join(result_dir, '%06d.npy' % i), chunk)
+
+
+def _load_results_npy(dirname):
+    data = {}
+    grid_dir = os.path.join(dirname, 'grid')
+    for fname in sorted(os.listdir(grid_dir)):
+        data[os.path.splitext(fname)[0]] = np.load(os.path.join(grid_dir,
+                                                                fname))
+    with open(os.path.join(dirname, 'params.json')) as f:
+        data['params'] = json.load(f)
+
+    for name in sorted(os.listdir(dirname)):
+        result_dir = os.path.join(dirname, name)
+        if name == 'grid' or not os.path.isdir(result_dir):
+            continue
+        blocks = [np.load(os.path.join(result_dir, fname), mmap_mode='r')
+                  for fname in sorted(os.listdir(result_dir))]
+        data[name] = np.concatenate(blocks, axis=-1)
+    return data
+
+
+def save_model(dirname, arrays, params):
+    """
+    Writes the model matrices as .npy files and the parameters
+    they were built with as JSON.
+
+    **Parameters**
+
+    dirname : str
+        directory for the model files
+
+    arrays : dict
+        names of the matrices mapped to numpy arrays
+
+    params : dict
+        scalar parameters of the solver
+    """
+    if not os.path.isdir(dirname):
+        os.makedirs(dirname)
+    for (name, array) in arrays.items():
+        np.save(os.path.join(dirname, name + '.npy'), array)
+    with open(os.path.join(dirname, 'params.json'), 'w') as f:
+        json.dump(params, f, indent=4, sort_keys=True)
+
+
+def load_model(dirname, mmap_mode='r'):
+    """
+    Reads a model written by save_model().
+
+    **Parameters**
+
+    dirname : str
+        directory with the model files
+
+    mmap_mode : str or None, optional
+        memory mapping mode passed to np.load, large matrices are then
+        read from disk only when they are used
+
+    **Returns**
+
+    arrays : dict
+        names of the matrices mapped to numpy arrays
+
+    params : dict
+        scalar parameters the model was built with
+    """
+    arrays = {}
+    for fname in sorted(os.listdir(dirname)):
+        (name, ext) = os.path.splitext(fname)
+        if ext == '.npy':
+            arrays[name] = np.load(os.path.join(dirname, fname),
+                                   mmap_mode=mmap_mode)
+    with open(os.path.join(dirname, 'params.json')) as f:
+        params = json.load(f)
+    return arrays, params
+
+
+def check_model_parameters(params, current_params):
+    """
+    Raises an exception if the model was built with parameters
+    different from the current ones.
+    """
+    for (key, value) in params.items():
+        if key in RUNTIME_PARAMETERS:
+            continue
+        if current_params.get(key) != value:
+            raise Exception("Model was built with a different value "
+                            "of parameter %s!" % key)
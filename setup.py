@@ -21,6 +21,10 @@ requirements = [
     # TODO: put package requirements here
 ]
 
+extra_requirements = {
+    'hdf5': ['h5py'],
+}
+
 test_requirements = [
     # TODO: put package test requirements here
 ]
@@ -40,6 +44,7 @@ setup(
                  'pykCSD'},
     include_package_data=True,
     install_requires=requirements,
+    extras_require=extra_requirements,
     license="BSD",
     zip_safe=False,
     keywords=[
@@ -8,12 +8,22 @@ test_pykCSD
 Tests for `pykCSD` module.
 """
 
+import os
+import sys
+import shutil
+import tempfile
 import unittest
+import subprocess
+from functools import partial
 
 import numpy as np
 from pylab import *
-from numpy.linalg import norm
+from numpy import dot, identity
+from numpy.linalg import norm, inv
+from scipy import integrate
+from scipy.special import erf
 
+from pykCSD.KCSD1D import KCSD1D
 from pykCSD.KCSD2D import KCSD2D
 from pykCSD.pykCSD import KCSD
 from pykCSD import potentials as pt
@@ -21,13 +31,21 @@ from pykCSD import basis_functions as bf
 from pykCSD import source_distribution as sd
 from pykCSD import dist_table_utils as dt
 from pykCSD import cross_validation as cv
+from pykCSD import matrix_utils as mu
 from sklearn.cross_validation import LeaveOneOut
 
+try:
+    import h5py
+except ImportError:
+    h5py = None
+
 
 class TestKCSD1D(unittest.TestCase):
 
     def setUp(self):
-        pass
+        # master tables are cached globally, the tests start without them
+        self.master_tables = pt._master_tables.copy()
+        pt._master_tables.clear()
 
     def test_KCSD_1D_int_pot(self):
         """results of int_pot_1D() should be similar to matlab results"""
@@ -54,6 +72,139 @@ class TestKCSD1D(unittest.TestCase):
             # print 'ex:', expected_result, ' kcsd:', kcsd_result
             self.assertAlmostEqual(expected_result, kcsd_result, places=3)
 
+    def test_KCSD_1D_vectorized_pot(self):
+        """potential at many distances should match pointwise evaluation"""
+        xs = np.linspace(0.0, 2.0, 11)
+        pots = pt.b_pot_1d(xs, 0.3, 0.5, 1.0, bf.gauss_rescale_lim_1D)
+        for (x, pot) in zip(xs, pots):
+            expected = pt.b_pot_1d_cont(0, x, 0.3, 0.5, 1.0,
+                                        bf.gauss_rescale_lim_1D)
+            self.assertAlmostEqual(pot, expected, places=12)
+
+    def test_KCSD_1D_master_tables_size(self):
+        """only the recently used master tables should be kept"""
+        for h in np.linspace(0.1, 1.0, pt.MASTER_TABLES_SIZE + 5):
+            pt.b_pot_scaled(pt.b_pot_1d, 0.5, 1.0, h, 1.0,
+                            bf.step_rescale_1D)
+        self.assertEqual(len(pt._master_tables), pt.MASTER_TABLES_SIZE)
+
+    def test_KCSD_1D_parallel_dist_table(self):
+        """dist_table computed by a pool of workers should match serial"""
+        serial = dt.create_dist_table(bf.gauss_rescale_lim_1D, pt.b_pot_1d,
+                                      0.3, 0.5, 1.0, 2.0, 100)
+        for executor in ('thread', 'process'):
+            parallel = dt.create_dist_table(bf.gauss_rescale_lim_1D,
+                                            pt.b_pot_1d, 0.3, 0.5, 1.0,
+                                            2.0, 100, n_jobs=2,
+                                            executor=executor)
+            self.assertTrue(np.array_equal(serial, parallel))
+
+    def test_KCSD_1D_dist_table_cache(self):
+        """cached dist_table should be reused, also for shorter tables"""
+        cache_dir = tempfile.mkdtemp()
+        try:
+            args = (bf.gauss_rescale_lim_1D, pt.b_pot_1d, 0.3, 0.5, 1.0)
+            table = dt.create_dist_table(*(args + (2.0, 100)),
+                                         vectorized=True, cache_dir=cache_dir)
+            cached = dt.create_dist_table(*(args + (2.0, 100)),
+                                          vectorized=True, cache_dir=cache_dir)
+            shorter = dt.create_dist_table(*(args + (1.0, 50)),
+                                           vectorized=True,
+                                           cache_dir=cache_dir)
+            self.assertTrue(np.array_equal(table, cached))
+            np.testing.assert_allclose(shorter, table[:50], rtol=1e-10)
+            self.assertEqual(len(os.listdir(cache_dir)), 2)
+        finally:
+            shutil.rmtree(cache_dir)
+
+    def test_KCSD_1D_dist_table_step(self):
+        """a model with a smaller space should reuse a cached larger table"""
+        cache_dir = tempfile.mkdtemp()
+        try:
+            models = []
+            for (x_max, n_sources) in [(2.0, 11), (1.0, 6)]:
+                elec_pos = np.linspace(0.0, x_max, 5).reshape(-1, 1)
+                params = {'n_sources': n_sources, 'R_init': 0.2,
+                          'dist_table_step': 0.01,
+                          'dist_table_cache': cache_dir}
+                k = KCSD1D(elec_pos, np.ones((5, 1)), params)
+                k.create_dist_table()
+                self.assertAlmostEqual(k.dist_max / k.dist_density, 0.01)
+                models.append(k)
+            (large, small) = models
+            self.assertEqual(large.R, small.R)
+            self.assertTrue(np.array_equal(
+                small.dist_table, large.dist_table[:small.dist_density]))
+            # the smaller table was served from the larger one
+            self.assertEqual(len(os.listdir(cache_dir)), 2)
+        finally:
+            shutil.rmtree(cache_dir)
+
+    def test_KCSD_1D_dist_table_cache_concurrency(self):
+        """cache directory created concurrently and read-only tables
+        should not raise"""
+        cache_dir = os.path.join(tempfile.mkdtemp(), 'cache')
+        args = (bf.gauss_rescale_lim_1D, pt.b_pot_1d, 0.3, 0.5, 1.0,
+                2.0, 100)
+        (makedirs, utime) = (os.makedirs, os.utime)
+
+        def concurrent_makedirs(path, *args):
+            makedirs(path, *args)
+            raise OSError("File exists")
+
+        def read_only_utime(path, *args):
+            raise OSError("Read-only file system")
+
+        try:
+            os.makedirs = concurrent_makedirs
+            table = dt.create_dist_table(*args, vectorized=True,
+                                         cache_dir=cache_dir)
+            os.makedirs = makedirs
+            self.assertEqual(len(os.listdir(cache_dir)), 2)
+            os.utime = read_only_utime
+            cached = dt.create_dist_table(*args, vectorized=True,
+                                          cache_dir=cache_dir)
+            self.assertTrue(np.array_equal(table, cached))
+        finally:
+            (os.makedirs, os.utime) = (makedirs, utime)
+            shutil.rmtree(os.path.dirname(cache_dir))
+
+    def test_KCSD_1D_dist_table_cache_lambdas(self):
+        """different lambdas should not share a cache entry"""
+        cache_dir = tempfile.mkdtemp()
+        try:
+            ones = lambda x, R, h, sigma, basis: np.ones_like(x)
+            twos = lambda x, R, h, sigma, basis: 2 * np.ones_like(x)
+            for (pot_func, value) in [(ones, 1.0), (twos, 2.0)]:
+                table = dt.create_dist_table(bf.gauss_rescale_lim_1D,
+                                             pot_func, 0.3, 0.5, 1.0,
+                                             2.0, 100, vectorized=True,
+                                             cache_dir=cache_dir)
+                self.assertTrue(np.all(table == value))
+            self.assertEqual(os.listdir(cache_dir), [])
+        finally:
+            shutil.rmtree(cache_dir)
+
+    def test_KCSD_1D_dist_table_cache_key(self):
+        """cache key of a scaled potential should not depend on the process"""
+        code = ("from functools import partial\n"
+                "from pykCSD import basis_functions as bf\n"
+                "from pykCSD import dist_table_utils as dt\n"
+                "from pykCSD import potentials as pt\n"
+                "pot_func = partial(pt.b_pot_scaled, pt.b_pot_1d)\n"
+                "print(dt.cache_metadata(bf.gauss_rescale_lim_1D, pot_func,"
+                " 0.3, 0.5, 1.0, 2.0, 100, True)['key'])\n")
+        env = dict(os.environ)
+        package_dir = os.path.dirname(os.path.dirname(dt.__file__))
+        env['PYTHONPATH'] = os.pathsep.join(
+            [package_dir] + [p for p in [env.get('PYTHONPATH')] if p])
+        key = subprocess.check_output([sys.executable, '-c', code], env=env)
+        pot_func = partial(pt.b_pot_scaled, pt.b_pot_1d)
+        meta = dt.cache_metadata(bf.gauss_rescale_lim_1D, pot_func,
+                                 0.3, 0.5, 1.0, 2.0, 100, True)
+        self.assertEqual(key.decode('utf-8').strip(), meta['key'])
+        self.assertNotIn('0x', meta['pot_func'])
+
     def test_KCSD_1D_cross_validation_two_electrodes(self):
         """cross validation should promote high lambdas in this case"""
 
@@ -104,7 +255,8 @@ class TestKCSD1D(unittest.TestCase):
             k = KCSD(elec_pos=np.array([[0], [0]]), sampled_pots=[[0], [0]])
 
     def tearDown(self):
-        pass
+        pt._master_tables.clear()
+        pt._master_tables.update(self.master_tables)
 
 
 class TestKCSD1D_full_reconstruction(unittest.TestCase):
@@ -201,6 +353,55 @@ class TestKCSD2D(unittest.TestCase):
                                         basis_func=bf.gauss_rescale_lim_2D)
             self.assertAlmostEqual(expected_result, kcsd_result, places=3)
 
+    def test_KCSD_2D_quad_pot(self):
+        """vectorized quadrature should agree with dblquad integration"""
+        (R, h) = (0.5, 1.0)
+        xs = np.array([0.0, 0.3, 0.5, 1.5])
+
+        # gauss basis is integrated over the square, step basis over
+        # the disk, where it is smooth
+        def square_pot(x, basis):
+            (pot, err) = integrate.dblquad(pt.int_pot_2D, -R, R,
+                                           lambda xp: -R, lambda xp: R,
+                                           args=(x, R, h, basis),
+                                           epsrel=1e-10, epsabs=0)
+            return pot/(2*np.pi)
+
+        def disk_pot(x, basis):
+            def integrand(r, theta):
+                return r*pt.int_pot_2D(r*np.cos(theta), r*np.sin(theta),
+                                       x, R, h, basis)
+            (pot, err) = integrate.dblquad(integrand, 0.0, np.pi,
+                                           lambda theta: 0.0,
+                                           lambda theta: R,
+                                           epsrel=1e-10, epsabs=0)
+            return pot/np.pi
+
+        for (basis, expected_pot) in [(bf.gauss_rescale_2D, square_pot),
+                                      (bf.step_rescale_2D, disk_pot)]:
+            pots = pt.b_pot_2d_quad(xs, R, h, 1.0, basis)
+            expected = [expected_pot(x, basis) for x in xs]
+            np.testing.assert_allclose(pots, expected, rtol=1e-5)
+
+    def test_KCSD_2D_quad_pot_blocks(self):
+        """distances integrated in several blocks should match one by one"""
+        xs = np.linspace(0.0, 2.0, pt.QUADRATURE_BLOCK_2D + 7)
+        pots = pt.b_pot_2d_quad(xs, 0.5, 1.0, 1.0, bf.step_rescale_2D)
+        self.assertEqual(pots.shape, xs.shape)
+        for i in [0, pt.QUADRATURE_BLOCK_2D - 1, pt.QUADRATURE_BLOCK_2D,
+                  len(xs) - 1]:
+            pot = pt.b_pot_2d_quad(xs[i], 0.5, 1.0, 1.0, bf.step_rescale_2D)
+            self.assertAlmostEqual(pot, pots[i], places=12)
+
+    def test_KCSD_2D_scaled_pot(self):
+        """rescaled master table should match direct integration"""
+        xs = np.linspace(0.0, 5.0, 21)
+        for (R, h, sigma) in [(0.5, 1.0, 1.0), (2.0, 4.0, 0.3)]:
+            expected = pt.b_pot_2d_quad(xs, R, h, sigma, bf.step_rescale_2D)
+            pots = pt.b_pot_scaled(pt.b_pot_2d_quad, xs, R, h, sigma,
+                                   bf.step_rescale_2D)
+            np.testing.assert_allclose(pots, expected, rtol=1e-7)
+
     def test_KCSD_2D_zero_pot(self):
         elec_pos = np.array([[0, 0], [0, 1], [1, 0], [1, 1]])
         pots = np.array([[0], [0], [0], [0]])
@@ -299,6 +500,291 @@ class TestKCSD2D_full_recostruction(unittest.TestCase):
 
         self.assertGreater(self.k.lambd, 25.0)
 
+    def test_KCSD2D_closed_form_loo(self):
+        """closed-form leave-one-out error should match refitting"""
+        n_elec = self.k.elec_pos.shape[0]
+        for lambd in [0.01, 1.0, 50.0]:
+            loo_err = cv.loo_cross_validation(lambd, self.k.sampled_pots,
+                                              self.k.k_pot)
+            err = cv.cross_validation(lambd, self.k.sampled_pots,
+                                      self.k.k_pot, LeaveOneOut(n_elec))
+            self.assertAlmostEqual(loo_err, err, places=10)
+        lambdas = np.array([100.0/2**n for n in range(1, 20)])
+        lambd = cv.choose_lambda(lambdas, self.k.sampled_pots,
+                                 self.k.k_pot, self.k.elec_pos)
+        self.assertGreater(lambd, 25.0)
+
+    def test_KCSD2D_cross_validation_path(self):
+        """errors for the whole lambda path should match single lambdas"""
+        lambdas = np.array([100.0/2**n for n in range(1, 20)])
+        index_generator = LeaveOneOut(self.k.elec_pos.shape[0])
+        errors = cv.cross_validation_path(lambdas, self.k.sampled_pots,
+                                          self.k.k_pot, index_generator)
+        for (lambd, err) in zip(lambdas, errors):
+            expected = cv.cross_validation(lambd, self.k.sampled_pots,
+                                           self.k.k_pot, index_generator)
+            self.assertAlmostEqual(err, expected, places=10)
+
+    def test_KCSD2D_parallel_cross_validation(self):
+        """cross validation with many threads should match serial run"""
+        lambdas = np.array([100.0/2**n for n in range(1, 20)])
+        index_generator = LeaveOneOut(self.k.elec_pos.shape[0])
+        serial = cv.cross_validation_path(lambdas, self.k.sampled_pots,
+                                          self.k.k_pot, index_generator)
+        parallel = cv.cross_validation_path(lambdas, self.k.sampled_pots,
+                                            self.k.k_pot, index_generator,
+                                            n_jobs=3)
+        self.assertTrue(np.array_equal(serial, parallel))
+        self.assertEqual(cv.cross_validation(1.0, self.k.sampled_pots,
+                                             self.k.k_pot, index_generator),
+                         cv.cross_validation(1.0, self.k.sampled_pots,
+                                             self.k.k_pot, index_generator,
+                                             n_jobs=3))
+        self.assertEqual(cv.choose_lambda(lambdas, self.k.sampled_pots,
+                                          self.k.k_pot, self.k.elec_pos),
+                         cv.choose_lambda(lambdas, self.k.sampled_pots,
+                                          self.k.k_pot, self.k.elec_pos,
+                                          n_jobs=3))
+
+    def test_KCSD2D_multiple_timepoints(self):
+        """estimation of many time samples should match estimating each one"""
+        single_pots = self.k.sampled_pots
+        self.k.estimate_csd()
+        single_csd = self.k.estimated_csd
+        self.k.sampled_pots = np.hstack([single_pots, -2 * single_pots])
+        self.k.estimate_csd()
+        np.testing.assert_almost_equal(self.k.estimated_csd[:, :, :1],
+                                       single_csd, decimal=10)
+        np.testing.assert_almost_equal(self.k.estimated_csd[:, :, 1:],
+                                       -2 * single_csd, decimal=10)
+
+    def test_KCSD2D_k_pot_factorization_cache(self):
+        """k_pot should be factorized once and refactorized after a change"""
+        factorization = self.k.factorize_k_pot()
+        self.assertIs(self.k.factorize_k_pot(), factorization)
+        for lambd in [0.0, 0.1, 10.0]:
+            expected_inv = inv(self.k.k_pot + lambd * identity(5))
+            np.testing.assert_almost_equal(factorization.inverse(lambd),
+                                           expected_inv, decimal=6)
+        self.k.k_pot = 2 * self.k.k_pot
+        self.assertIsNot(self.k.factorize_k_pot(), factorization)
+
+    def test_KCSD2D_csd_operator(self):
+        """csd operator applied to pots should give the estimated csd"""
+        operator = self.k.get_csd_operator()
+        self.assertEqual(operator.shape, (self.k.space_X.size, 5))
+        self.assertIs(self.k.get_csd_operator(), operator)
+        self.k.estimate_csd()
+        np.testing.assert_almost_equal(
+            dot(operator, self.k.sampled_pots),
+            self.k.estimated_csd.reshape(operator.shape[0], -1),
+            decimal=10
+        )
+
+    def test_KCSD2D_transform_without_sampled_pots(self):
+        """model built without pots should reconstruct any new recording"""
+        params = {'n_sources': 9, 'gdX': 0.1, 'gdY': 0.1}
+        k = KCSD2D(self.k.elec_pos, params=params)
+        k.init_model()
+        self.k.estimate_csd()
+        self.k.estimate_pots()
+        np.testing.assert_almost_equal(k.transform(self.k.sampled_pots),
+                                       self.k.estimated_csd, decimal=10)
+        np.testing.assert_almost_equal(
+            k.transform(self.k.sampled_pots, 'pots'),
+            self.k.estimated_pots, decimal=10
+        )
+        with self.assertRaises(Exception):
+            k.transform(np.zeros((4, 1)))
+        with self.assertRaises(Exception):
+            k.estimate_csd()
+
+    def test_KCSD2D_iterate_transform(self):
+        """chunked estimation should give the same result as transform"""
+        pots = np.dot(self.k.sampled_pots, np.linspace(-1.0, 1.0, 7)[None, :])
+        chunks = list(self.k.iterate_transform(pots, 'csd', chunk_size=3))
+        self.assertEqual([chunk.shape[2] for chunk in chunks], [3, 3, 1])
+        np.testing.assert_almost_equal(np.concatenate(chunks, axis=2),
+                                       self.k.transform(pots, 'csd'),
+                                       decimal=10)
+
+    def test_KCSD2D_iterate_transform_validation(self):
+        """iterate_transform should reject bad input before iterating"""
+        self.assertRaises(Exception, self.k.iterate_transform, None)
+        self.assertRaises(Exception, self.k.iterate_transform,
+                          np.ones((2, 7)))
+        self.assertRaises(Exception, self.k.iterate_transform,
+                          self.k.sampled_pots, 'lfp')
+        self.assertRaises(Exception, self.k.iterate_transform,
+                          self.k.sampled_pots, 'csd', 0)
+
+    def test_KCSD2D_memmap_pots(self):
+        """memory-mapped pots should give the same result as in-memory pots"""
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            pots = np.dot(self.k.sampled_pots, np.ones((1, 5)))
+            mm_pots = np.memmap(os.path.join(tmp_dir, 'pots.dat'),
+                                dtype=float, mode='w+', shape=pots.shape)
+            mm_pots[:] = pots
+            self.k.chunk_size = 2
+            np.testing.assert_almost_equal(self.k.transform(mm_pots),
+                                           self.k.transform(pots), decimal=10)
+            del mm_pots
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_KCSD2D_save_load_npy(self):
+        """results saved in .npy blocks should be loaded unchanged"""
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            self.k.sampled_pots = np.dot(self.k.sampled_pots, np.ones((1, 5)))
+            filename = os.path.join(tmp_dir, 'result')
+            self.k.save(filename, chunk_size=2)
+            expected_csd = self.k.estimate_csd()
+            expected_pots = self.k.estimate_pots()
+            data = self.k.load(filename)
+            np.testing.assert_almost_equal(self.k.estimated_csd,
+                                           expected_csd, decimal=10)
+            np.testing.assert_almost_equal(self.k.estimated_pots,
+                                           expected_pots, decimal=10)
+            np.testing.assert_almost_equal(data['space_X'], self.k.space_X)
+            self.assertEqual(data['params']['n_sources'], 9)
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_KCSD2D_save_reads_chunks_once(self):
+        """save should read every chunk of on-disk pots only once"""
+        class CountingPots(object):
+            def __init__(self, pots):
+                self.pots = pots
+                self.shape = pots.shape
+                self.reads = 0
+
+            def __getitem__(self, key):
+                self.reads += 1
+                return self.pots[key]
+
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            pots = np.dot(self.k.sampled_pots, np.ones((1, 5)))
+            self.k.sampled_pots = CountingPots(pots)
+            self.k.save(os.path.join(tmp_dir, 'result'), chunk_size=2)
+            self.assertEqual(self.k.sampled_pots.reads, 3)
+            self.k.load(os.path.join(tmp_dir, 'result'))
+            np.testing.assert_almost_equal(self.k.estimated_csd,
+                                           self.k.transform(pots, 'csd'),
+                                           decimal=10)
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_KCSD2D_save_load_model(self):
+        """loaded model should give the same estimation as the built one"""
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            model_dir = os.path.join(tmp_dir, 'model')
+            self.k.save_model(model_dir)
+            params = {'n_sources': 9, 'gdX': 0.1, 'gdY': 0.1}
+            k = KCSD2D(self.k.elec_pos, self.k.sampled_pots, params)
+            k.load_model(model_dir)
+            self.assertIsInstance(k.k_interp_cross, np.memmap)
+            np.testing.assert_almost_equal(k.estimate_csd(),
+                                           self.k.estimate_csd(), decimal=10)
+            params['n_sources'] = 16
+            k = KCSD2D(self.k.elec_pos, self.k.sampled_pots, params)
+            with self.assertRaises(Exception):
+                k.load_model(model_dir)
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    @unittest.skipIf(h5py is None, 'h5py is not installed')
+    def test_KCSD2D_save_load_hdf5(self):
+        """results saved to HDF5 should be loaded unchanged"""
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            self.k.sampled_pots = np.dot(self.k.sampled_pots, np.ones((1, 5)))
+            filename = os.path.join(tmp_dir, 'result.h5')
+            self.k.save(filename, chunk_size=2)
+            expected_csd = self.k.estimate_csd()
+            data = self.k.load(filename)
+            np.testing.assert_almost_equal(self.k.estimated_csd,
+                                           expected_csd, decimal=10)
+            np.testing.assert_almost_equal(data['space_Y'], self.k.space_Y)
+            self.assertEqual(data['params']['source_type'], 'gauss')
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    @unittest.skipIf(h5py is None, 'h5py is not installed')
+    def test_KCSD2D_hdf5_pots(self):
+        """pots stored in HDF5 should give the same result as in-memory"""
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            pots = np.dot(self.k.sampled_pots, np.ones((1, 5)))
+            with h5py.File(os.path.join(tmp_dir, 'pots.h5'), 'w') as f:
+                h5_pots = f.create_dataset('pots', data=pots)
+                self.k.chunk_size = 2
+                np.testing.assert_almost_equal(self.k.transform(h5_pots),
+                                               self.k.transform(pots),
+                                               decimal=10)
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_KCSD2D_low_memory(self):
+        """blockwise accumulated cross matrices should match the dense ones"""
+        params = {'n_sources': 9, 'gdX': 0.1, 'gdY': 0.1,
+                  'low_memory': True, 'mem_budget': 2000}
+        k = KCSD2D(self.k.elec_pos, self.k.sampled_pots, params)
+        k.init_model()
+        self.assertIsNone(k.b_src_matrix)
+        self.assertIsNone(k.b_interp_pot_matrix)
+        np.testing.assert_almost_equal(k.k_interp_cross,
+                                       self.k.k_interp_cross, decimal=10)
+        np.testing.assert_almost_equal(k.interp_pot, self.k.interp_pot,
+                                       decimal=10)
+
+    def test_KCSD2D_fft(self):
+        """FFT convolution should match the dense cross matrices"""
+        elec_pos = np.array([[0, 0], [0, 1], [1, 0], [1, 1], [0.5, 0.5]])
+        pots = np.array([[0.1], [0.2], [0.3], [0.4], [0.5]])
+        params = {'n_sources': 9, 'gdX': 0.1, 'gdY': 0.1}
+        k_dense = KCSD2D(elec_pos, pots, params)
+        k_dense.init_model()
+        params['fft'] = True
+        k_fft = KCSD2D(elec_pos, pots, params)
+        k_fft.init_model()
+        self.assertIsNone(k_fft.b_src_matrix)
+        np.testing.assert_almost_equal(k_fft.k_interp_cross,
+                                       k_dense.k_interp_cross, decimal=10)
+        np.testing.assert_almost_equal(k_fft.interp_pot,
+                                       k_dense.interp_pot, decimal=10)
+
+    def test_KCSD2D_fft_distance_ties(self):
+        """FFT interp_pot should match the dense one up to the dist_table
+        resolution with nearest lookup and exactly with spline lookup"""
+        elec_pos = np.array([[0, 0], [0, 1], [1, 0], [1, 1], [0.5, 0.5]])
+        pots = np.array([[0.1], [0.2], [0.3], [0.4], [0.5]])
+        for source_type in ['gauss', 'step']:
+            for dist_lookup in ['nearest', 'spline']:
+                params = {'n_sources': 16, 'gdX': 0.1, 'gdY': 0.1,
+                          'source_type': source_type,
+                          'dist_lookup': dist_lookup}
+                k_dense = KCSD2D(elec_pos, pots, dict(params))
+                k_dense.init_model()
+                params['fft'] = True
+                k_fft = KCSD2D(elec_pos, pots, params)
+                k_fft.init_model()
+                self.assertIsNone(k_fft.b_src_matrix)
+                if dist_lookup == 'spline':
+                    np.testing.assert_almost_equal(k_fft.interp_pot,
+                                                   k_dense.interp_pot,
+                                                   decimal=10)
+                    continue
+                # a distance on the boundary between two samples may be
+                # looked up in either of them
+                step = np.max(np.abs(np.diff(k_dense.dist_table)))
+                bound = step * np.sum(np.abs(k_dense.b_pot_matrix), axis=0)
+                diff = np.abs(k_fft.interp_pot - k_dense.interp_pot)
+                self.assertTrue(np.all(diff <= bound + 1e-12))
+
     def tearDown(self):
         pass
 
@@ -306,7 +792,9 @@ class TestKCSD2D_full_recostruction(unittest.TestCase):
 class TestKCSD3D_full_recostruction(unittest.TestCase):
 
     def setUp(self):
-        pass
+        # master tables are cached globally, the tests start without them
+        self.master_tables = pt._master_tables.copy()
+        pt._master_tables.clear()
 
     def test_KCSD_3D_zero_pot(self):
         """if the input pots are zero, estimated pots and csd should be zero"""
@@ -330,8 +818,76 @@ class TestKCSD3D_full_recostruction(unittest.TestCase):
     def test_KCSD_3D_model_pots(self):
         pass
 
+    def test_KCSD_3D_analytic_pot(self):
+        """closed-form 3D potentials should match radial integration"""
+        R, sigma = 0.6, 0.7
+        for basis in [bf.step_rescale_3D, bf.gauss_rescale_3D]:
+            xs = np.array([0.0, 0.2, 0.59, 0.61, 1.5])
+            pots = pt.b_pot_3d_analytic(xs, R, 0.0, sigma, basis)
+            for (x, pot) in zip(xs, pots):
+                def shell_pot(r):
+                    shell = 4 * np.pi * r**2 * basis(r, 0, 0, [0, 0, 0], R)
+                    return shell / max(x, r) / (4 * np.pi * sigma)
+                expected, err = integrate.quad(shell_pot, 0, 4 * R,
+                                               points=[x, R], limit=200)
+                self.assertAlmostEqual(pot, expected, places=10)
+        with self.assertRaises(Exception):
+            pt.b_pot_3d_analytic(0.1, R, 0.0, sigma, bf.gauss_rescale_lim_3D)
+
+    def test_KCSD_3D_dist_table_lookup(self):
+        """spline lookup should be more accurate than the nearest sample"""
+        R = 1.0
+        dist_max = 10.0
+        dists = np.random.RandomState(0).uniform(0, dist_max - 0.1, 1000)
+        expected = pt.b_pot_3d_analytic(dists, R, 0, 1.0, bf.gauss_rescale_3D)
+        short = dt.create_dist_table(bf.gauss_rescale_3D,
+                                     pt.b_pot_3d_analytic, R, 0, 1.0,
+                                     dist_max, 200, vectorized=True)
+        lookup = dt.make_lookup(short, dist_max, 'spline')
+        spline_err = np.max(np.abs(dt.generated_potential(dists, dist_max,
+                                                          lookup) - expected))
+        # more samples than np.uint16 indices could address
+        long = dt.create_dist_table(bf.gauss_rescale_3D,
+                                    pt.b_pot_3d_analytic, R, 0, 1.0,
+                                    dist_max, 100000, vectorized=True)
+        nearest_err = np.max(np.abs(dt.generated_potential(dists, dist_max,
+                                                           long) - expected))
+        self.assertLess(nearest_err, 1e-5)
+        self.assertLess(spline_err, nearest_err)
+
+    def test_KCSD_3D_radial_pot(self):
+        """radial quadrature should agree with the closed-form potentials"""
+        R, sigma = 0.6, 0.7
+        xs = np.linspace(0.0, 3.0, 31)
+        for basis in [bf.step_rescale_3D, bf.gauss_rescale_3D]:
+            np.testing.assert_almost_equal(
+                pt.b_pot_3d_radial(xs, R, 0.0, sigma, basis),
+                pt.b_pot_3d_analytic(xs, R, 0.0, sigma, basis),
+                decimal=10
+            )
+        # the cut off gaussian gives the potential of a point charge
+        # scaled by the mass within 3 standard deviations
+        pots = pt.b_pot_3d_radial(xs, R, 0.0, sigma, bf.gauss_rescale_lim_3D)
+        x = xs[xs > R]
+        mass = erf(3 / np.sqrt(2)) - np.sqrt(2 / np.pi) * 3 * np.exp(-4.5)
+        np.testing.assert_almost_equal(pots[xs > R],
+                                       mass / (4 * np.pi * sigma * x),
+                                       decimal=10)
+
+    def test_KCSD_3D_scaled_pot_master_table(self):
+        """3D potentials for different R should share one master table"""
+        xs = np.linspace(0.0, 5.0, 21)
+        for R in [0.5, 1.0, 2.0]:
+            expected = pt.b_pot_3d_radial(xs, R, 1.0, 1.0,
+                                          bf.gauss_rescale_lim_3D)
+            pots = pt.b_pot_scaled(pt.b_pot_3d_radial, xs, R, 1.0, 1.0,
+                                   bf.gauss_rescale_lim_3D)
+            np.testing.assert_allclose(pots, expected, rtol=1e-6, atol=1e-12)
+        self.assertEqual(len(pt._master_tables), 1)
+
     def tearDown(self):
-        pass
+        pt._master_tables.clear()
+        pt._master_tables.update(self.master_tables)
 
 
 class TestKCSD_all_utils(unittest.TestCase):
@@ -471,6 +1027,72 @@ class TestKCSD_all_utils(unittest.TestCase):
                 for x, xe in zip(x_row, xe_row):
                     self.assertEqual(x, xe)
 
+    def test_b_pot_matrix_vectorized(self):
+        """vectorized b_pot_matrix should match the pointwise lookup"""
+        src_pos = np.array([[0.0, 0.0], [0.5, 0.0], [1.0, 1.0]])
+        elec_pos = np.array([[0.1, 0.2], [0.9, 0.3]])
+        dist_table = np.linspace(1.0, 0.0, 50)
+        dist_max = 2.0
+        b_pot = mu.calculate_b_pot_matrix(src_pos, elec_pos, dist_max,
+                                          dist_table)
+        for i, src in enumerate(src_pos):
+            for j, elec in enumerate(elec_pos):
+                expected = dt.generated_potential(norm(elec - src), dist_max,
+                                                  dist_table)
+                self.assertEqual(b_pot[i, j], expected)
+
+    def test_b_src_matrix_blocked(self):
+        """blocked b_src_matrix should not depend on the memory budget"""
+        grid_pos = np.random.rand(30, 2)
+        src_pos = np.random.rand(7, 2)
+        b_src = mu.calculate_b_src_matrix(bf.gauss_rescale_2D, grid_pos,
+                                          src_pos, 0.5, 2**20)
+        b_src_blocked = mu.calculate_b_src_matrix(bf.gauss_rescale_2D,
+                                                  grid_pos, src_pos, 0.5, 500)
+        self.assertTrue(np.array_equal(b_src, b_src_blocked))
+        for i, src in enumerate(src_pos):
+            expected = bf.gauss_rescale_2D(grid_pos[:, 0], grid_pos[:, 1],
+                                           src, 0.5)
+            self.assertTrue(np.allclose(b_src[:, i], expected))
+
+    def test_b_src_matrix_sparse(self):
+        """sparse b_src_matrix of a compact basis should match the dense one"""
+        grid_pos = np.random.rand(200, 3)
+        src_pos = np.random.rand(20, 3)
+        for basis in [bf.step_rescale_3D, bf.gauss_rescale_lim_3D]:
+            self.assertTrue(bf.has_compact_support(basis))
+            dense = mu.calculate_b_src_matrix(basis, grid_pos, src_pos, 0.3,
+                                              2**20)
+            sparse = mu.calculate_sparse_b_src_matrix(basis, grid_pos,
+                                                      src_pos, 0.3)
+            self.assertEqual(sparse.nnz, np.count_nonzero(dense))
+            self.assertTrue(np.array_equal(sparse.toarray(), dense))
+        self.assertFalse(bf.has_compact_support(bf.gauss_rescale_3D))
+
+    def test_b_src_matrix_separable(self):
+        """separable gauss b_src_matrix should match the dense one"""
+        (lin_x, lin_y) = (np.linspace(0, 1, 7), np.linspace(0, 2, 5))
+        (src_x, src_y) = (np.linspace(-0.5, 1.5, 4), np.linspace(0, 2, 3))
+        (X, Y) = np.meshgrid(lin_x, lin_y)
+        (X_src, Y_src) = np.meshgrid(src_x, src_y)
+        grid_pos = np.column_stack((X.ravel(), Y.ravel()))
+        src_pos = np.column_stack((X_src.ravel(order='F'),
+                                   Y_src.ravel(order='F')))
+        dense = mu.calculate_b_src_matrix(bf.gauss_rescale_2D, grid_pos,
+                                          src_pos, 0.8, 2**20)
+        separable = mu.calculate_separable_b_src_matrix(
+            bf.gauss_rescale_2D, [(1, lin_y), (0, lin_x)],
+            [(0, src_x), (1, src_y)], 0.8
+        )
+        np.testing.assert_almost_equal(separable, dense, decimal=12)
+        b_pot = np.random.rand(len(src_pos), 3)
+        k_interp_cross = mu.calculate_separable_k_interp_cross(
+            bf.gauss_rescale_2D, [(1, lin_y), (0, lin_x)],
+            [(0, src_x), (1, src_y)], 0.8, b_pot
+        )
+        np.testing.assert_almost_equal(k_interp_cross, dot(dense, b_pot),
+                                       decimal=12)
+
     def test_gauss1Dlim_basis_normalized(self):
         mu = 0
         three_std = 1.0